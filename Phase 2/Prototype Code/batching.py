@@ -0,0 +1,147 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from model_registry import registry, MODEL_PATH
+from metrics import registry as metrics_registry
+
+
+"""
+
+#######################################################################################################################################################################333
+DYNAMIC MICRO BATCHING
+
+Requests that arrive within a short window are stacked into one batch tensor
+and sent to the model in a single run. Each caller gets a Future holding the
+output rows of its own image.
+"""
+
+BATCHING_ENABLED = os.environ.get("REVA_BATCHING", "1") == "1"
+MAX_BATCH_SIZE = int(os.environ.get("REVA_MAX_BATCH_SIZE", "4"))
+MAX_WAIT_MS = float(os.environ.get("REVA_MAX_WAIT_MS", "10"))
+
+
+def static_batch_size(session):
+    """
+    Function reads the batch dimension the model was exported with
+    :param session: onnxruntime.InferenceSession
+    :return: The fixed batch size, or None when the batch dimension is dynamic
+    """
+    dim = session.get_inputs()[0].shape[0]
+    return dim if isinstance(dim, int) and dim > 0 else None
+
+
+class MicroBatcher:
+    """
+    Queue in front of one model. A single background thread collects pending
+    inputs until max_batch_size is reached or max_wait_ms has passed since the
+    first one arrived, then runs them together. Models exported with a static
+    batch dimension are run one input at a time.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model_path = model_path
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, input):
+        """
+        Function queues one input tensor for inference
+        :param input: Numpy array in a shape (1,3,width,height)
+        :return: concurrent.futures.Future resolving to the raw output of shape (1,4+classes,candidates)
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((input, future))
+        return future
+
+    def pending(self):
+        """
+        Function returns the number of inputs waiting to be batched
+        """
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            limit = self._batch_limit()
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _batch_limit(self):
+        try:
+            fixed = static_batch_size(registry.get(self.model_path))
+        except Exception:
+            # let _run report the loading error to the callers
+            return 1
+        if fixed is not None:
+            # graph was exported with a static batch dimension, fall back to one image per run
+            return 1
+        return self.max_batch_size
+
+    def _run(self, batch):
+        # inputs of different shapes cannot share a tensor, run each shape group separately
+        groups = {}
+        for input, future in batch:
+            if future.set_running_or_notify_cancel():
+                groups.setdefault(input.shape, []).append((input, future))
+
+        for items in groups.values():
+            try:
+                session = registry.get(self.model_path)
+                if len(items) == 1:
+                    inputs = items[0][0]
+                else:
+                    inputs = np.concatenate([input for input, _ in items])
+                output = session.run(["output0"], {"images": inputs})[0]
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            for index, (_, future) in enumerate(items):
+                future.set_result(output[index:index + 1])
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(model_path=MODEL_PATH):
+    """
+    Function returns the shared batcher of a model, creating it on first use
+    :param model_path: Path of the ONNX model
+    :return: MicroBatcher
+    """
+    with _batchers_lock:
+        batcher = _batchers.get(model_path)
+        if batcher is None:
+            batcher = _batchers[model_path] = MicroBatcher(model_path)
+        return batcher
+
+
+metrics_registry.gauge("reva_batcher_queue_depth", "Inputs waiting to be batched, all models",
+                       lambda: sum(batcher.pending() for batcher in list(_batchers.values())))
@@ -0,0 +1,25 @@
+"""
+
+#######################################################################################################################################################################333
+DETECTION PIPELINE BENCHMARK
+
+Times every stage of a detection (prepare_input, run_model, process_output,
+get_image_geolocation and the database write) on a generated corpus of JPEG
+images with GPS metadata, over several image sizes and detection densities,
+and the startup of a fresh worker up to its first answered request.
+Nothing is downloaded, the default model is a small stand-in ONNX graph whose
+detections follow the bright patches drawn into the corpus, so results only
+depend on the code and the machine.
+
+    python -m benchmark --output results.json
+    python -m benchmark --save-baseline benchmark/baseline.json
+    python -m benchmark --baseline benchmark/baseline.json
+
+Run from the Prototype Code folder. With --baseline the exit status is 1 when
+a stage got slower than the baseline by more than the tolerance. Building the
+stand-in model needs the "onnx" package.
+"""
+
+from benchmark.corpus import generate_corpus, synthetic_image
+from benchmark.runner import run_benchmark, compare_results, measure_startup
+from benchmark.standin import build_standin_model
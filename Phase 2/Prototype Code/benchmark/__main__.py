@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from benchmark.corpus import generate_corpus
+from benchmark.runner import run_benchmark, compare_results, measure_startup
+from benchmark.standin import build_standin_model
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detection pipeline on a synthetic corpus")
+    parser.add_argument("--model", help="ONNX model to run, defaults to a generated stand-in model")
+    parser.add_argument("--input-size", type=int, default=640, help="input size of the stand-in model")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[(640, 480), (1920, 1080), (4000, 3000)],
+                        help="image sizes as WIDTHxHEIGHT")
+    parser.add_argument("--densities", nargs="+", type=int, default=[0, 20, 200], help="objects per image")
+    parser.add_argument("--images", type=int, default=5, help="images per size and density")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every image")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh workers started to time startup, 0 to skip")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--save-baseline", help="also write the results to this file as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 for 20%%")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="reva-benchmark-") as workdir:
+        model_path = args.model or build_standin_model(os.path.join(workdir, "standin.onnx"), args.input_size)
+
+        from model_registry import registry
+        corpus = generate_corpus(args.sizes, args.densities, args.images, registry.input_size(model_path), args.seed)
+        results = run_benchmark(corpus, model_path, workdir, repeat=args.repeat)
+        if args.startup_runs:
+            results["startup"] = measure_startup(model_path, workdir, args.startup_runs)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        results["regressions"] = compare_results(results, baseline, args.tolerance)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+
+    for regression in results.get("regressions", []):
+        print("Regression:", json.dumps(regression), file=sys.stderr)
+    return 1 if results.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
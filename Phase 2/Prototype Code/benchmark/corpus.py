@@ -0,0 +1,86 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+
+"""
+
+#######################################################################################################################################################################333
+SYNTHETIC CORPUS
+
+JPEG images of dark noise with bright square patches, one patch per expected
+detection, and EXIF GPS, altitude and capture time so the metadata stage reads
+the same tags as on drone captures. A seed gives the same corpus on every run.
+"""
+
+# Side of a patch in cells of the stand-in model, a cell is 8 model pixels
+PATCH_CELLS = 3
+
+
+def _to_dms(value):
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round(((value - degrees) * 60 - minutes) * 60, 4)
+    return degrees, minutes, seconds
+
+
+def synthetic_image(width, height, detections, input_size, rng, latitude=10.8958, longitude=106.6953, quality=90):
+    """
+    Function draws one corpus image
+    :param width: Width of the image
+    :param height: Height of the image
+    :param detections: Number of bright patches
+    :param input_size: Side of the square model input, patches are sized to cover PATCH_CELLS model cells
+    :param rng: numpy Generator
+    :param latitude: Latitude written to the EXIF GPS block
+    :param longitude: Longitude written to the EXIF GPS block
+    :param quality: JPEG quality
+    :return: JPEG bytes
+    """
+    pixels = rng.integers(0, 110, size=(height, width, 3), dtype=np.uint8)
+
+    # side of a patch in image pixels once the image is letterboxed into the model input
+    scale = input_size / max(width, height)
+    side = max(2, int(PATCH_CELLS * 8 / scale))
+    for _ in range(detections):
+        x = int(rng.integers(0, max(1, width - side)))
+        y = int(rng.integers(0, max(1, height - side)))
+        pixels[y:y + side, x:x + side] = 255
+
+    exif = Image.Exif()
+    exif[0x0132] = "2024:05:01 09:30:00"
+    exif[0x8825] = {
+        1: "N" if latitude >= 0 else "S", 2: _to_dms(abs(latitude)),
+        3: "E" if longitude >= 0 else "W", 4: _to_dms(abs(longitude)),
+        5: 0, 6: 35.0,
+        7: (9.0, 30.0, 0.0), 29: "2024:05:01",
+    }
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, "JPEG", quality=quality, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def generate_corpus(sizes, densities, images_per_group, input_size, seed=0):
+    """
+    Function generates the benchmark corpus, one group per size and density
+    :param sizes: List of (width, height)
+    :param densities: List of patch counts per image
+    :param images_per_group: Images generated for every size and density
+    :param input_size: Side of the square model input
+    :param seed: Seed of the random generator
+    :return: List of dictionaries with "group", "filename", "data", "width", "height" and "density"
+    """
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for width, height in sizes:
+        for density in densities:
+            group = f"{width}x{height}/d{density}"
+            for index in range(images_per_group):
+                # spread the images over a small area so every one gets its own location
+                data = synthetic_image(width, height, density, input_size, rng,
+                                       latitude=10.8958 + index * 0.001, longitude=106.6953 + index * 0.001)
+                corpus.append({"group": group, "filename": f"{width}x{height}_d{density}_{index}.jpg", "data": data,
+                               "width": width, "height": height, "density": density})
+    return corpus
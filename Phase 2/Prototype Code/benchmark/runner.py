@@ -0,0 +1,240 @@
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+
+"""
+
+#######################################################################################################################################################################333
+BENCHMARK RUNNER
+
+Runs every corpus image through the stages of /detect one after the other,
+timing each stage with perf_counter, and reduces the samples of every group
+to percentiles. The app module is imported from a scratch folder, so its
+database and caches never touch the working copy.
+
+Worker startup is timed in fresh interpreters: importing app, create_app()
+(schema setup and model preload) and the first request.
+"""
+
+STAGES = ("prepare_input", "run_model", "process_output", "get_image_geolocation", "save_image", "pipeline")
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be loaded once they are needed, reported when importing app already loads them
+LAZY_MODULES = ("onnxruntime", "plotly", "pandas", "geopy", "waitress")
+
+# Run in a new interpreter by measure_startup, prints its timings as the last line
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+loaded = [name for name in %r if name in sys.modules]
+app.create_app()
+initialized = time.perf_counter()
+status = app.app.test_client().get("/").status_code
+answered = time.perf_counter()
+print(json.dumps({"import": imported - start, "init": initialized - imported, "first_request": answered - initialized,
+                  "ready": answered - start, "status": status, "loaded": loaded}))
+""" % (LAZY_MODULES,)
+
+
+def peak_rss_mb():
+    """
+    Function returns the peak resident set size of the process so far
+    :return: Megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(seconds):
+    """
+    Function reduces the timings of one stage to latency percentiles and throughput
+    :param seconds: List of durations in seconds
+    :return: Dictionary with "p50_ms", "p95_ms", "p99_ms", "mean_ms" and "throughput_per_s"
+    """
+    milliseconds = np.array(seconds) * 1000
+    p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+    return {
+        "samples": len(seconds),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "mean_ms": round(float(milliseconds.mean()), 3),
+        "throughput_per_s": round(len(seconds) / float(np.sum(seconds)), 2) if np.sum(seconds) > 0 else None,
+    }
+
+
+def _load_app(workdir):
+    # importing app has no side effects, create_app() is not called so nothing is preloaded
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        # keep its startup messages out of the JSON written to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+
+def run_benchmark(corpus, model_path, workdir, repeat=3, warmup=2):
+    """
+    Function times the detection stages over a corpus
+    :param corpus: List from corpus.generate_corpus
+    :param model_path: Path of the ONNX model to run
+    :param workdir: Scratch folder for the database written by the save_image stage
+    :param repeat: Times every image is run, more samples give steadier p99 values
+    :param warmup: Untimed runs of the first image before measuring
+    :return: Dictionary with "meta", "groups" (per group stage summaries) and "peak_rss_mb"
+    """
+    app = _load_app(workdir)
+    from detection import prepare_input, run_model, process_output
+    from migrations import migrate
+    from model_registry import registry
+    from repository import save_image
+
+    db_path = os.path.join(workdir, "benchmark.db")
+    with contextlib.redirect_stdout(sys.stderr):
+        migrate(db_path)
+    input_size = registry.input_size(model_path)
+
+    def run_once(item, timings):
+        data = item["data"]
+        start = time.perf_counter()
+        tensor, img_width, img_height = prepare_input(data, input_size)
+        prepared = time.perf_counter()
+        output = run_model(tensor, model_path)
+        inferred = time.perf_counter()
+        boxes = process_output(output, img_width, img_height, input_size)
+        processed = time.perf_counter()
+        geolocation = app.get_image_geolocation(data)
+        located = time.perf_counter()
+        save_image(db_path, 1, item["filename"], boxes, geolocation["latitude"], geolocation["longitude"],
+                   geolocation["captured_at"])
+        saved = time.perf_counter()
+
+        if timings is not None:
+            timings["prepare_input"].append(prepared - start)
+            timings["run_model"].append(inferred - prepared)
+            timings["process_output"].append(processed - inferred)
+            timings["get_image_geolocation"].append(located - processed)
+            timings["save_image"].append(saved - located)
+            timings["pipeline"].append(saved - start)
+        return boxes
+
+    for _ in range(warmup):
+        run_once(corpus[0], None)
+
+    groups = {}
+    for item in corpus:
+        group = groups.setdefault(item["group"], {"timings": {stage: [] for stage in STAGES}, "detections": []})
+        for _ in range(repeat):
+            boxes = run_once(item, group["timings"])
+        group["detections"].append(len(boxes))
+
+    results = {}
+    for name, group in groups.items():
+        results[name] = {
+            "images": len(group["detections"]),
+            "detections_mean": round(float(np.mean(group["detections"])), 1),
+            "stages": {stage: summarize(group["timings"][stage]) for stage in STAGES},
+        }
+
+    return {
+        "meta": {
+            "model": os.path.basename(model_path),
+            "input_size": input_size,
+            "repeat": repeat,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "onnxruntime": ort.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "groups": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def measure_startup(model_path, workdir, runs=5):
+    """
+    Function times the startup of a worker in fresh interpreters
+    :param model_path: Model preloaded by create_app()
+    :param workdir: Scratch folder, the runs share its database like restarts of one worker
+    :param runs: Number of interpreters started
+    :return: Dictionary with the median "import_ms", "init_ms", "first_request_ms" and "ready_ms",
+             and "eagerly_loaded", the LAZY_MODULES already loaded by importing app
+    """
+    startup_dir = os.path.join(workdir, "startup")
+    os.makedirs(startup_dir, exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=APP_DIR, REVA_MODEL_PATH=model_path, REVA_MODEL_PATHS=model_path,
+               REVA_PRELOAD_MODEL="1")
+
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=startup_dir, env=env,
+                                   capture_output=True, text=True, check=True)
+        sample = json.loads(completed.stdout.strip().splitlines()[-1])
+        if sample["status"] != 200:
+            raise RuntimeError(f"First request of the started worker returned {sample['status']}")
+        samples.append(sample)
+
+    result = {"runs": runs}
+    for name in ("import", "init", "first_request", "ready"):
+        result[name + "_ms"] = round(float(np.median([sample[name] for sample in samples])) * 1000, 1)
+    result["eagerly_loaded"] = sorted({name for sample in samples for name in sample["loaded"]})
+    return result
+
+
+def compare_results(current, baseline, tolerance=0.2, min_delta_ms=0.5, metrics=("p50_ms", "p95_ms")):
+    """
+    Function compares a run with a baseline run, stage by stage
+    :param current: Result of run_benchmark
+    :param baseline: Result of run_benchmark stored earlier
+    :param tolerance: Allowed slowdown as a fraction, 0.2 accepts up to 20% slower
+    :param min_delta_ms: Slowdowns smaller than this are timer noise and never reported
+    :param metrics: Latency fields compared
+    :return: List of regressions, dictionaries with "group", "stage", "metric", "baseline", "current" and "ratio"
+    """
+    regressions = []
+    for name, group in current["groups"].items():
+        reference = baseline.get("groups", {}).get(name)
+        if reference is None:
+            continue
+        for stage, summary in group["stages"].items():
+            reference_summary = reference["stages"].get(stage)
+            if reference_summary is None:
+                continue
+            for metric in metrics:
+                before, after = reference_summary[metric], summary[metric]
+                if after > before * (1 + tolerance) and after - before > min_delta_ms:
+                    regressions.append({"group": name, "stage": stage, "metric": metric, "baseline": before,
+                                        "current": after, "ratio": round(after / before, 2) if before else None})
+
+    startup, reference_startup = current.get("startup"), baseline.get("startup")
+    if startup and reference_startup:
+        for metric in ("import_ms", "ready_ms"):
+            before, after = reference_startup[metric], startup[metric]
+            # process startup is noisier than a stage, a few milliseconds are not reported
+            if after > before * (1 + tolerance) and after - before > max(min_delta_ms, 20):
+                regressions.append({"group": None, "stage": "startup", "metric": metric, "baseline": before,
+                                    "current": after, "ratio": round(after / before, 2) if before else None})
+
+    peak, reference_peak = current.get("peak_rss_mb"), baseline.get("peak_rss_mb")
+    if peak and reference_peak and peak > reference_peak * (1 + tolerance):
+        regressions.append({"group": None, "stage": None, "metric": "peak_rss_mb", "baseline": reference_peak,
+                            "current": peak, "ratio": round(peak / reference_peak, 2)})
+    return regressions
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+"""
+
+#######################################################################################################################################################################333
+STAND-IN MODEL
+
+A tiny ONNX graph with the input and output layout of the YOLOv8 detector
+("images" (N,3,S,S) to "output0" (N,5,S/8*S/8)). Every 8x8 cell of the input is
+one candidate centred on the cell, its score is high when the cell is bright,
+so the number of boxes follows the patches of the synthetic corpus. It runs in
+milliseconds on any CPU, the benchmark then measures the code around the model.
+"""
+
+CELL = 8
+
+# Fixed box side in model pixels
+BOX_SIDE = 24.0
+
+
+def build_standin_model(path, input_size=640):
+    """
+    Function writes the stand-in model
+    :param path: Where to write the ONNX file
+    :param input_size: Side of the square model input, a multiple of 8
+    :return: path
+    """
+    try:
+        import onnx
+        from onnx import helper, numpy_helper, TensorProto
+    except ImportError:
+        raise ImportError("Building the stand-in model needs the onnx package")
+
+    if input_size % CELL:
+        raise ValueError(f"input_size must be a multiple of {CELL}")
+    grid = input_size // CELL
+
+    # score: mean brightness of the cell pushed through a steep sigmoid, dark noise stays near 0
+    mean_weights = np.full((1, 3, CELL, CELL), 1.0 / (3 * CELL * CELL), dtype=np.float32)
+    gain = np.array(40.0, dtype=np.float32)
+    offset = np.array(-0.75 * 40.0, dtype=np.float32)
+
+    # box columns: zero convolution broadcast with the fixed centre, width and height of every cell
+    centres = (np.arange(grid, dtype=np.float32) + 0.5) * CELL
+    boxes = np.empty((1, 4, grid, grid), dtype=np.float32)
+    boxes[0, 0] = centres[None, :]
+    boxes[0, 1] = centres[:, None]
+    boxes[0, 2:] = BOX_SIDE
+
+    initializers = [
+        numpy_helper.from_array(mean_weights, "mean_weights"),
+        numpy_helper.from_array(np.zeros((4, 3, CELL, CELL), dtype=np.float32), "zero_weights"),
+        numpy_helper.from_array(gain, "gain"),
+        numpy_helper.from_array(offset, "offset"),
+        numpy_helper.from_array(boxes, "boxes"),
+        numpy_helper.from_array(np.array([0, 5, -1], dtype=np.int64), "shape"),
+    ]
+    nodes = [
+        helper.make_node("Conv", ["images", "mean_weights"], ["mean"], kernel_shape=[CELL, CELL], strides=[CELL, CELL]),
+        helper.make_node("Mul", ["mean", "gain"], ["scaled"]),
+        helper.make_node("Add", ["scaled", "offset"], ["logits"]),
+        helper.make_node("Sigmoid", ["logits"], ["scores"]),
+        helper.make_node("Conv", ["images", "zero_weights"], ["zeros"], kernel_shape=[CELL, CELL], strides=[CELL, CELL]),
+        helper.make_node("Add", ["zeros", "boxes"], ["cells"]),
+        helper.make_node("Concat", ["cells", "scores"], ["grid"], axis=1),
+        helper.make_node("Reshape", ["grid", "shape"], ["output0"]),
+    ]
+    graph = helper.make_graph(
+        nodes, "standin",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, ["N", 3, input_size, input_size])],
+        [helper.make_tensor_value_info("output0", TensorProto.FLOAT, ["N", 5, grid * grid])],
+        initializers,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+    return path
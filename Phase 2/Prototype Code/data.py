@@ -1,24 +1,26 @@
-import onnxruntime as ort
-from flask import request, Flask, jsonify, render_template,session,redirect,url_for,flash
+from flask import request, Flask, jsonify, render_template,session,redirect,url_for,flash,send_file,Response
 # import session
-from flask_sqlalchemy import SQLAlchemy
 import bcrypt
-from waitress import serve
-from PIL import Image
-import pandas as pd
-import plotly.express as px 
-import pandas as pd
-import numpy as np
-import exifread
 import sqlite3
-from fractions import Fraction
+import json
+from model_registry import registry
+from tiling import TILED_INFERENCE
+from model_selection import select_model, load, MODEL_PATHS, QUALITY_LEVELS
+from detection import detect_objects_on_image, detection_settings
+from db import get_connection
+from figure_cache import figure_cache, data_etag, image_columns, PLOTLY_JS_PATH, PLOTLY_VERSION
+from migrations import migrate
+from exif_metadata import read_image_metadata
+from preprocess import read_upload
+from result_cache import content_hash
+from geocoding import create_reverse_geocoder
+from repository import (save_image, fetch_image_location, fetch_filename_counts, fetch_locations,
+                        fetch_image_summary, fetch_user_totals, fetch_daily_counts, fetch_user_detections)
 import os
-import time
-import uuid
+import threading
 
-# use geopy to get location from lat and lon
-from geopy.geocoders import Nominatim
-geolocator = Nominatim(user_agent="object-detection-app_1}")
+# use geopy or a local gazetteer to get location from lat and lon, cached on disk (see geocoding.py)
+reverse_geocoder = create_reverse_geocoder(user_agent="object-detection-app_1}")
 
 
 app = Flask(__name__)
@@ -29,229 +31,70 @@ app = Flask(__name__)
 
 app.secret_key = 'secret_key'
 
-import sqlite3
-
-# Connect to the SQLite database file (REVA.db)
+# SQLite database file, its tables are created or upgraded by init_app
 db_path = "REVA.db"
-connection = sqlite3.connect(db_path)
-cursor = connection.cursor()
-
-# Create the User table
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS user (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name VARCHAR(100) NOT NULL,
-        email VARCHAR(100) UNIQUE NOT NULL,
-        password VARCHAR(100) NOT NULL
-    )
-""")
-
-# Create the object_detection_data table
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS object_detection_data (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        filename TEXT,
-        x1 INTEGER,
-        y1 INTEGER,
-        x2 INTEGER,
-        y2 INTEGER,
-        object_type TEXT,
-        probability REAL,
-        latitude REAL,
-        longitude REAL,
-        FOREIGN KEY (user_id) REFERENCES user (id)
-    )
-""")
-
-# Commit the changes and close the connection
-connection.commit()
-connection.close()
-
-print("Database tables created successfully.")
-
-
-
-"""
-
-#######################################################################################################################################################################333
-THIS SECTION CONTAIN OBJECT DETECTION RELATED CODE
-"""
-
-# Location of the image taken fuctions
-
-def get_image_geolocation(file):
-    # Function to extract geolocation from image metadata using exifread library
-    file.seek(0)
-    tags = exifread.process_file(file)
-
-    latitude_ref = tags.get("GPS GPSLatitudeRef")
-    latitude = tags.get("GPS GPSLatitude")
-    longitude_ref = tags.get("GPS GPSLongitudeRef")
-    longitude = tags.get("GPS GPSLongitude")
-
-    if latitude_ref and latitude and longitude_ref and longitude:
-        latitude = parse_exif_gps_value(latitude)
-        longitude = parse_exif_gps_value(longitude)
-
-        # Convert the latitude and longitude from degrees, minutes, seconds to decimal degrees
-        latitude_dec = convert_dms_to_dd(latitude)
-        longitude_dec = convert_dms_to_dd(longitude)
-
-        # Adjust the sign of latitude and longitude based on their reference
-        if latitude_ref.values == "S":
-            latitude_dec = -latitude_dec
-        if longitude_ref.values == "W":
-            longitude_dec = -longitude_dec
-
-        return {"latitude": latitude_dec, "longitude": longitude_dec}
-    else:
-        raise ValueError("Geolocation data not found in image metadata.")
-
-
-def parse_exif_gps_value(value):
-    # Helper function to parse EXIF GPS coordinates in the format "[x, y, z]"
-    parts = str(value).replace("[", "").replace("]", "").split(", ")
-    degrees = float(parts[0])
-    minutes_frac = Fraction(parts[1])
-    seconds_frac = Fraction(parts[2])
-    
-    # Convert fractions to float
-    minutes = minutes_frac.numerator / minutes_frac.denominator
-    seconds = seconds_frac.numerator / seconds_frac.denominator
-    
-    return degrees, minutes, seconds
-
-def convert_dms_to_dd(dms):
-    # Function to convert degrees, minutes, seconds to decimal degrees
-    degrees, minutes, seconds = dms
-    dd = degrees + minutes / 60.0 + seconds / 3600.0
-    return dd
-
 
+# Load and warm up the detection models in init_app instead of on the first request
+PRELOAD_MODEL = os.environ.get("REVA_PRELOAD_MODEL", "1") == "1"
 
+_initialized = False
+_init_lock = threading.Lock()
 
-# IOU and YOLOv8 classes
 
-def iou(box1,box2):
+def init_app(preload=PRELOAD_MODEL):
     """
-    Function calculates "Intersection-over-union" coefficient for specified two boxes
-    https://pyimagesearch.com/2016/11/07/intersection-over-union-iou-for-object-detection/.
-    :param box1: First box in format: [x1,y1,x2,y2,object_class,probability]
-    :param box2: Second box in format: [x1,y1,x2,y2,object_class,probability]
-    :return: Intersection over union ratio as a float number
+    Function runs the startup work of the worker once: creates or upgrades the database tables and loads the models.
+    Importing this module does none of it, see create_app() in app.py
+    :param preload: Load and warm up MODEL_PATHS
     """
-    return intersection(box1,box2)/union(box1,box2)
-
-
-def union(box1,box2):
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        migrate(db_path)
+        print("Database tables created successfully.")
+        if preload:
+            for model_path in MODEL_PATHS:
+                registry.preload(model_path)
+        _initialized = True
+
+
+def create_app():
     """
-    Function calculates union area of two boxes
-    :param box1: First box in format [x1,y1,x2,y2,object_class,probability]
-    :param box2: Second box in format [x1,y1,x2,y2,object_class,probability]
-    :return: Area of the boxes union as a float number
+    Application factory, used by main() and by WSGI servers
+    :return: The Flask app, initialized
     """
-    box1_x1,box1_y1,box1_x2,box1_y2 = box1[:4]
-    box2_x1,box2_y1,box2_x2,box2_y2 = box2[:4]
-    box1_area = (box1_x2-box1_x1)*(box1_y2-box1_y1)
-    box2_area = (box2_x2-box2_x1)*(box2_y2-box2_y1)
-    return box1_area + box2_area - intersection(box1,box2)
+    init_app()
+    return app
 
 
-def intersection(box1,box2):
-    """
-    Function calculates intersection area of two boxes
-    :param box1: First box in format [x1,y1,x2,y2,object_class,probability]
-    :param box2: Second box in format [x1,y1,x2,y2,object_class,probability]
-    :return: Area of intersection of the boxes as a float number
-    """
-    box1_x1,box1_y1,box1_x2,box1_y2 = box1[:4]
-    box2_x1,box2_y1,box2_x2,box2_y2 = box2[:4]
-    x1 = max(box1_x1,box2_x1)
-    y1 = max(box1_y1,box2_y1)
-    x2 = min(box1_x2,box2_x2)
-    y2 = min(box1_y2,box2_y2)
-    return (x2-x1)*(y2-y1)
+@app.before_request
+def ensure_initialized():
+    # app served without the factory, the first request does the setup
+    if not _initialized:
+        init_app()
 
 
-# Array of YOLOv8 class labels
-yolo_classes = ["0"]
 
+"""
+
+#######################################################################################################################################################################333
+THIS SECTION CONTAIN OBJECT DETECTION RELATED CODE
+"""
+
+# Location of the image taken fuctions
+
+def get_image_geolocation(file):
+    # Function to extract geolocation, altitude and capture time from the EXIF header of the image,
+    # file is an upload stream or the buffer returned by read_upload
+    metadata = read_image_metadata(file)
+
+    if metadata["latitude"] is None or metadata["longitude"] is None:
+        raise ValueError("Geolocation data not found in image metadata.")
+    return metadata
 
-# function 3
-def process_output(output, img_width, img_height):
-    """
-    Function used to convert RAW output from YOLOv8 to an array
-    of detected objects. Each object contain the bounding box of
-    this object, the type of object and the probability
-    :param output: Raw output of YOLOv8 network which is an array of shape (1,84,8400)
-    :param img_width: The width of original image
-    :param img_height: The height of original image
-    :return: Array of detected objects in a format [[x1,y1,x2,y2,object_type,probability],..]
-    """
-    output = output[0].astype(float)
-    output = output.transpose()
-
-    boxes = []
-    for row in output:
-        prob = row[4:].max()
-        if prob < 0.2:
-            continue
-        class_id = row[4:].argmax()
-        label = yolo_classes[class_id]
-        xc, yc, w, h = row[:4]
-        x1 = (xc - w/2) / 2176 * img_width
-        y1 = (yc - h/2) / 2176 * img_height
-        x2 = (xc + w/2) / 2176 * img_width
-        y2 = (yc + h/2) / 2176 * img_height
-        boxes.append([x1, y1, x2, y2, label, prob])
-
-    boxes.sort(key=lambda x: x[5], reverse=True)
-    result = []
-    while len(boxes) > 0:
-        result.append(boxes[0])
-        boxes = [box for box in boxes if iou(box, boxes[0]) < 0.3] 
-
-    return result
-
-
-# function 3
-def run_model(input):
-    """
-    Function used to pass provided input tensor to
-    YOLOv8 neural network and return result
-    :param input: Numpy array in a shape (3,width,height)
-    :return: Raw output of YOLOv8 network as an array of shape (1,84,8400)
-    """
-    model = ort.InferenceSession("Phase2_TeamAtlanticModel.onnx")
-    outputs = model.run(["output0"], {"images":input})
-    return outputs[0]
 
 
-# function 2
-def prepare_input(buf):
-    """
-    Function used to convert input image to tensor,
-    required as an input to YOLOv8 object detection
-    network.
-    :param buf: Uploaded file input stream
-    :return: Numpy array in a shape (3,width,height) where 3 is number of color channels
-    """
-    img = Image.open(buf)
-    img_width, img_height = img.size
-    img = img.resize((2176, 2176))
-    img = img.convert("RGB")
-    input = np.array(img) / 255.0
-    input = input.transpose(2, 0, 1)
-    input = input.reshape(1, 3, 2176, 2176)
-    return input.astype(np.float32), img_width, img_height
-
-
-# Function 1
-def detect_objects_on_image(stream):
-    input, img_width, img_height = prepare_input(stream)
-    output = run_model(input)
-    return process_output(output, img_width, img_height)
 
 """
 
@@ -261,90 +104,30 @@ Service Based Function
 
 
 def fetch_lat_lon_from_db_1(filename):
-    connection = None  # Initialize the connection variable outside the try block
-
     try:
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
         user = session.get("user")
         # Fetch one of the latitudes and longitudes for the given filename from the database as per user
-        query = "SELECT latitude, longitude FROM object_detection_data WHERE user_id = ? AND filename = ? LIMIT 1"
-        cursor.execute(query, (user, filename))
-        result = cursor.fetchone()
-
-        return result
+        return fetch_image_location(db_path, user, filename)
 
     except sqlite3.Error as error:
         print("Error fetching data from the database:", error)
 
-    finally:
-        if connection:
-            connection.close()
-
     # Handle the case where an error occurred
     return None  # You might want to return an appropriate value or raise an exception here
 
 
 def fetch_lat_lon_from_db():
-    # Connect to the database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
     # Fetch unique filenames and their count from the database as per user
     user = session.get("user")
-    cursor.execute("SELECT filename, COUNT(filename) FROM object_detection_data WHERE user_id = ? GROUP BY filename", (user,))
-    filenames_data = cursor.fetchall()
+    filenames_data = fetch_filename_counts(db_path, user)
 
     # Fetch unique latitudes and longitudes from the database as per user
-    cursor.execute( "SELECT latitude, longitude FROM object_detection_data WHERE user_id = ? GROUP BY latitude, longitude", (user,))
-    lat_lon_data = cursor.fetchall()
-
-    # Close the database connection
-    conn.close()
+    lat_lon_data = fetch_locations(db_path, user)
 
     return filenames_data, lat_lon_data
 
 
 
-def Bubble_map(db_name):
-    # get the data from the sqlite database 
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    # Fetch unique filenames and their count with their unique lat and long from the database as per user
-    cursor.execute("SELECT filename, COUNT(filename), latitude, longitude FROM object_detection_data WHERE user_id = ? GROUP BY filename, latitude, longitude", (session.get("user"),))
-    rows = cursor.fetchall()
-
-    # Create a dataframe from the rows
-    df = pd.DataFrame(rows, columns=['filename', 'Plastic_count', 'latitude', 'longitude'])
-    # Mapbox plot
-    mapbox_fig = px.scatter_mapbox(df, lat='latitude', lon='longitude', size='Plastic_count',
-                            color='Plastic_count', color_continuous_scale='plasma',
-                            zoom=18, mapbox_style='open-street-map')
-    mapbox_fig.update_traces(hovertemplate='<b>%{text}</b><br>' +
-                                    'Plastic Count: %{marker.size:,}<br>' +
-                                    'Latitude: %{lat}<br>' +
-                                    'Longitude: %{lon}<br>',
-                        text=df['filename'])
-    
-    # Bar plot
-    bar_fig = px.bar(df, x='filename', y='Plastic_count', color='Plastic_count', color_continuous_scale='plasma')
-    # add filename to the hover data
-    bar_fig.update_traces(hovertemplate='<b>%{text}</b><br>' +
-                                    'Plastic Count: %{y:,}<br>',
-                        text=df['filename'])
-    # line plot
-    line_fig = px.line(df, x='filename', y='Plastic_count')
-    
-    # convert the plots to html
-    mapbox_plot_div = mapbox_fig.to_html(full_html=False)
-    bar_plot_div = bar_fig.to_html(full_html=False)
-    line_plot_div = line_fig.to_html(full_html=False)
-
-
-    return mapbox_plot_div, bar_plot_div, line_plot_div
-
-
-
 """
 
 #######################################################################################################################################################################333
@@ -355,8 +138,7 @@ THIS SECTION CONTAIN DATA BASE RELATED CODE
 
 def get_user_by_email(email):
     try:
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
+        cursor = get_connection(db_path).cursor()
 
         # Fetch the user by email
         query = "SELECT * FROM User WHERE email = ?"
@@ -368,71 +150,46 @@ def get_user_by_email(email):
     except sqlite3.Error as error:
         print("Error fetching user by email:", error)
 
-    finally:
-        if connection:
-            connection.close()
-
     # Handle the case where an error occurred
     return None  # You might want to return an appropriate value or raise an exception here
 
 
 def add_user(email, password, name):
     try:
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
-        cursor.execute(
-            "INSERT INTO user (name, email, password) VALUES (?, ?, ?)",
-            (name, email, password)
-        )
-        connection.commit()
+        connection = get_connection(db_path)
+        # commits on success and rolls back on error so the pooled connection never keeps a lock
+        with connection:
+            connection.execute(
+                "INSERT INTO user (name, email, password) VALUES (?, ?, ?)",
+                (name, email, password)
+            )
         return True
     except sqlite3.Error as e:
         print("Error adding user:", e)
         return False
-    finally:
-        if connection:
-            connection.close()
 
-# Function to add object detection data to the database
-def add_object_detection_data(user_id, filename, x1, y1, x2, y2, object_type, probability, latitude, longitude):
+# Function to add the detections of an image to the database in one transaction
+def save_detections(user_id, filename, boxes, latitude, longitude, captured_at=None, image_hash=None):
+    # the error is raised on, /detect answers 500 instead of returning boxes that were not stored
     try:
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
-        cursor.execute(
-            "INSERT INTO object_detection_data (user_id, filename, x1, y1, x2, y2, object_type, probability, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, filename, x1, y1, x2, y2, object_type, probability, latitude, longitude)
-        )
-        connection.commit()
-        return True
+        # an image the user already uploaded (same image_hash) is not stored twice
+        save_image(db_path, user_id, filename, boxes, latitude, longitude, captured_at, image_hash)
     except sqlite3.Error as e:
         print("Error adding object detection data:", e)
-        return False
-    finally:
-        if connection:
-            connection.close()
+        raise
 
 # Function to get object detection data for a user
 def get_object_detection_data(user_id):
     try:
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT * FROM object_detection_data WHERE user_id = ?",
-            (user_id,)
-        )
-        return cursor.fetchall()
+        return fetch_user_detections(db_path, user_id)
     except sqlite3.Error as e:
         print("Error fetching object detection data:", e)
         return []
-    finally:
-        if connection:
-            connection.close()
 
 # Function to get a user by user_id
 def get_user(user_id):
     try:
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
+        cursor = get_connection(db_path).cursor()
         cursor.execute(
             "SELECT * FROM user WHERE id = ?",
             (user_id,)
@@ -441,9 +198,6 @@ def get_user(user_id):
     except sqlite3.Error as e:
         print("Error fetching user:", e)
         return None
-    finally:
-        if connection:
-            connection.close()
 
 
 
@@ -544,23 +298,18 @@ def database():
 
 @app.route("/get_lat_lon/<filename>")
 def get_lat_lon(filename):
-    print("Received filename:", filename)
     lat_lon = fetch_lat_lon_from_db_1(filename)
-    print("Latitude and Longitude:", lat_lon)
     return jsonify(lat_lon)
 
 @app.route("/get_location/<lat>/<lon>")
 def get_location(lat, lon):
-    print("Received lat and lon:", lat, lon)
-    location = geolocator.reverse(f"{lat}, {lon}", exactly_one=True)
-    print("Location:", location)
+    try:
+        location = reverse_geocoder.reverse(float(lat), float(lon))
+    except ValueError:
+        return jsonify({"error": "Invalid coordinates"}), 400
 
     if location:
-        location_data = {
-            "address": location.address,
-            "country": location.raw.get("address", {}).get("country"),
-            "postcode": location.raw.get("address", {}).get("postcode")
-        }
+        location_data = location
     else:
         location_data = {
             "address": "Location data not found",
@@ -577,15 +326,15 @@ def db_data():
     # Fetch data from the database
     filenames_data, lat_lon_data = fetch_lat_lon_from_db()
 
-    # get total number of plastic 
-    total_plastic = 0
-    for i in range(len(filenames_data)):
-        total_plastic += filenames_data[i][1]
+    # get total number of plastic and the daily counts from the running totals
+    user = session.get("user")
+    _, total_plastic = fetch_user_totals(db_path, user)
 
     d_b = {
         "filenames": filenames_data,
         "lat_lon": lat_lon_data,
-        "total_plastic": total_plastic
+        "total_plastic": total_plastic,
+        "daily": fetch_daily_counts(db_path, user)
     }
 
     return jsonify(d_b)
@@ -596,8 +345,38 @@ def db():
 
 @app.route("/visualize")
 def bubblemap():
-    mapbox, bar, line = Bubble_map(db_path)
-    return render_template('visualize.html', mapbox_plot_div=mapbox, bar_plot_div=bar, line_plot_div=line)
+    # the page only carries empty plots, the browser draws them from /visualize_data
+    return render_template('visualize.html', plotly_js_url=url_for("plotly_js", v=PLOTLY_VERSION))
+
+@app.route("/visualize_data")
+def visualize_data():
+    """
+    Handler of /visualize_data GET endpoint
+    Returns the detections per image of the user as columns, answers 304 when the client already has this version
+    :return: JSON object {"filename": [...], "count": [...], "latitude": [...], "longitude": [...]}
+    """
+    user = session.get("user")
+    # the running totals change with every stored image, no need to read the images to know the data changed
+    version = fetch_user_totals(db_path, user)
+    etag = data_etag(db_path, user, version)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = figure_cache.get_or_render(("visualize_data", db_path, user), version,
+                                          lambda: json.dumps(image_columns(fetch_image_summary(db_path, user))))
+        response = Response(body, mimetype="application/json")
+
+    # per user data, the browser keeps it but checks back every time
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route("/plotly.min.js")
+def plotly_js():
+    # the url carries the plotly version, browsers can keep the bundle for a year
+    return send_file(PLOTLY_JS_PATH, mimetype="application/javascript", max_age=365 * 24 * 3600)
 
 @app.route("/locate")
 def locate():
@@ -628,22 +407,46 @@ def detect():
 
     buf = request.files["image_file"]
     filename = buf.filename
-    print(filename)
-    boxes = detect_objects_on_image(buf.stream)
+    # "mode=tiled" in the form switches to sliced inference for very large images
+    tiled = request.form.get("mode", "tiled" if TILED_INFERENCE else "full") == "tiled"
+
+    # "quality" picks one of the served resolutions, "auto" degrades to a smaller model under load
+    quality = request.form.get("quality", "auto")
+    if quality not in QUALITY_LEVELS:
+        return jsonify({"error": f"Unknown quality: {quality}"}), 400
+
+    # "conf", "iou", "max_det" and "overlap" (tiled mode) override the deployment defaults for this request
+    try:
+        settings = detection_settings(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Read the upload once, the detector and the metadata reader share the buffer
+    image = read_upload(buf.stream)
+    # the same file uploaded again is answered from the result cache and not stored twice
+    image_hash = content_hash(image)
+
+    with load:
+        model_path = select_model(quality, load.value - 1)
+        boxes = detect_objects_on_image(image, tiled=tiled, model_path=model_path, image_hash=image_hash,
+                                        settings=settings)
 
     # Get geolocation from the image metadata
-    geolocation = get_image_geolocation(buf)
+    geolocation = get_image_geolocation(image)
 
 
     # Save the detected objects to the database
-    for box in boxes:
-        x1, y1, x2, y2, object_type, probability = box
-        add_object_detection_data(user_id, filename, x1, y1, x2, y2, object_type, probability, geolocation["latitude"], geolocation["longitude"])
+    try:
+        save_detections(user_id, filename, boxes, geolocation["latitude"], geolocation["longitude"],
+                        geolocation["captured_at"], image_hash)
+    except sqlite3.Error:
+        return jsonify({"error": "Storing the detections failed"}), 500
 
     return jsonify(boxes)
 
 
 def main():
+    create_app()
     app.run(debug=True,port = 8080)
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import threading
+
+
+"""
+
+#######################################################################################################################################################################333
+SQLITE CONNECTION MANAGEMENT
+
+Every thread keeps one open connection per database instead of connecting and
+closing in each helper. Connections are created in WAL mode so dashboard readers
+never block the /detect writer, and sqlite3 keeps the prepared statements of each
+connection in its statement cache, so repeated queries are not parsed again.
+"""
+
+JOURNAL_MODE = os.environ.get("REVA_SQLITE_JOURNAL_MODE", "WAL")
+
+# NORMAL is durable in WAL mode except for the last transactions on power loss
+SYNCHRONOUS = os.environ.get("REVA_SQLITE_SYNCHRONOUS", "NORMAL")
+
+# Negative cache size is in KiB, 64 MiB page cache and 256 MiB memory map per connection
+CACHE_SIZE = int(os.environ.get("REVA_SQLITE_CACHE_SIZE", "-65536"))
+MMAP_SIZE = int(os.environ.get("REVA_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Seconds a writer waits for the lock before "database is locked" is raised
+BUSY_TIMEOUT = float(os.environ.get("REVA_SQLITE_BUSY_TIMEOUT", "10"))
+
+# Prepared statements kept per connection
+STATEMENT_CACHE_SIZE = int(os.environ.get("REVA_SQLITE_STATEMENT_CACHE", "256"))
+
+
+def configure_connection(connection):
+    """
+    Function applies the tuning pragmas to a new connection
+    :param connection: sqlite3.Connection
+    """
+    # journal mode is stored in the database file, the others are per connection
+    connection.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+    connection.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    connection.execute(f"PRAGMA cache_size = {CACHE_SIZE}")
+    connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+
+
+class ConnectionPool:
+    """
+    Per thread pool of configured connections keyed by database path.
+    A connection is only ever used by the thread that opened it and is
+    closed when that thread exits.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, db_path):
+        """
+        Function returns the calling thread's connection to a database, opening it on first use
+        :param db_path: Path of the SQLite database
+        :return: sqlite3.Connection
+        """
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+
+        connection = connections.get(db_path)
+        if connection is None:
+            connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+            configure_connection(connection)
+            connections[db_path] = connection
+        return connection
+
+    def close(self, db_path=None):
+        """
+        Function closes the calling thread's connections
+        :param db_path: Only close the connection to this database, None for all of them
+        """
+        connections = getattr(self._local, "connections", {})
+        for path in list(connections):
+            if db_path is None or path == db_path:
+                connections.pop(path).close()
+
+
+# Shared pool for the whole process
+pool = ConnectionPool()
+
+
+def get_connection(db_path):
+    """
+    Function returns the calling thread's pooled connection to a database
+    :param db_path: Path of the SQLite database
+    :return: sqlite3.Connection, do not close it
+    """
+    return pool.get(db_path)
@@ -0,0 +1,205 @@
+import os
+
+from model_registry import registry, MODEL_PATH
+from postprocess import decode_output, batched_nms, scale_boxes, to_box_list
+from preprocess import prepare_image, load_rgb_image, INPUT_SIZE, JPEG_DRAFT
+from batching import get_batcher, BATCHING_ENABLED
+from tiling import detect_tiled, check_overlap, TILE_SIZE, TILE_OVERLAP
+from result_cache import result_cache, result_key, RESULT_CACHE_ENABLED
+from metrics import stage, DETECTIONS, METRICS_ENABLED
+
+
+"""
+
+#######################################################################################################################################################################333
+OBJECT DETECTION PIPELINE
+
+Shared by the Flask apps and the background job workers, importing this
+module has no side effects besides reading the model settings.
+"""
+
+
+# Array of YOLOv8 class labels
+yolo_classes = ["0"]
+
+# Deployment defaults of the detection settings, each request may override them (see detection_settings).
+# Candidates below CONF_THRESHOLD are dropped, boxes overlapping a kept box by IOU_THRESHOLD or more are
+# suppressed. Every remaining box is returned unless MAX_DETECTIONS caps them, the cap is opt-in since the
+# stored detection counts and summaries only see the boxes returned.
+CONF_THRESHOLD = float(os.environ.get("REVA_CONF_THRESHOLD", "0.2"))
+IOU_THRESHOLD = float(os.environ.get("REVA_IOU_THRESHOLD", "0.3"))
+MAX_DETECTIONS = int(os.environ.get("REVA_MAX_DETECTIONS", "0"))
+
+# Best candidates handed to NMS after the confidence cut, bounds its cost on crowded images
+MAX_NMS_CANDIDATES = int(os.environ.get("REVA_MAX_NMS_CANDIDATES", "30000"))
+
+
+def detection_settings(values=None):
+    """
+    Function reads the detection settings of a request, the ones not given keep the deployment defaults
+    :param values: Mapping such as request.form with optional "conf", "iou", "max_det" and "overlap"
+    :return: Dictionary with "conf_threshold", "iou_threshold", "max_detections" (None for no limit)
+             and "tile_overlap" (used by tiled inference only)
+    :raises ValueError: When a value is not a number or out of range
+    """
+    values = values or {}
+    conf_threshold = float(values.get("conf", CONF_THRESHOLD))
+    iou_threshold = float(values.get("iou", IOU_THRESHOLD))
+    max_detections = int(values.get("max_det", MAX_DETECTIONS))
+    tile_overlap = check_overlap(values.get("overlap", TILE_OVERLAP))
+
+    if not 0 <= conf_threshold <= 1:
+        raise ValueError("conf must be between 0 and 1")
+    if not 0 < iou_threshold <= 1:
+        raise ValueError("iou must be above 0 and at most 1")
+    if max_detections < 0:
+        raise ValueError("max_det must be 0 or more")
+    return {"conf_threshold": conf_threshold, "iou_threshold": iou_threshold,
+            "max_detections": max_detections or None, "tile_overlap": tile_overlap}
+
+
+def nms_settings(settings):
+    """
+    Function picks the settings of process_output from a detection_settings dictionary
+    """
+    return {name: settings[name] for name in ("conf_threshold", "iou_threshold", "max_detections")}
+
+
+# function 3
+def process_output(output, img_width, img_height, input_size=INPUT_SIZE, conf_threshold=CONF_THRESHOLD,
+                   iou_threshold=IOU_THRESHOLD, max_detections=MAX_DETECTIONS or None):
+    """
+    Function used to convert RAW output from YOLOv8 to an array
+    of detected objects. Each object contain the bounding box of
+    this object, the type of object and the probability
+    :param output: Raw output of YOLOv8 network which is an array of shape (1,84,8400)
+    :param img_width: The width of original image
+    :param img_height: The height of original image
+    :param input_size: Side of the square input of the model that produced the output
+    :param conf_threshold: Minimum class probability for a box to be kept
+    :param iou_threshold: Boxes overlapping a kept box by this much or more are dropped
+    :param max_detections: Maximum number of boxes returned, None for no limit
+    :return: Array of detected objects in a format [[x1,y1,x2,y2,object_type,probability],..]
+    """
+    with stage("postprocess"):
+        # low scores are cut before NMS, which then stops as soon as max_detections boxes are kept
+        boxes, scores, class_ids = decode_output(output, conf_threshold, MAX_NMS_CANDIDATES)
+        keep = batched_nms(boxes, scores, class_ids, iou_threshold=iou_threshold, top_k=max_detections, agnostic=True)
+
+        # map the kept boxes from the letterboxed model input back to the original image
+        boxes = scale_boxes(boxes[keep], img_width, img_height, input_size)
+
+        return to_box_list(boxes, scores[keep], class_ids[keep], yolo_classes)
+
+
+# function 3
+def run_model(input, model_path=MODEL_PATH):
+    """
+    Function used to pass provided input tensor to
+    YOLOv8 neural network and return result
+    :param input: Numpy array in a shape (3,width,height)
+    :param model_path: Path of the ONNX model to run
+    :return: Raw output of YOLOv8 network as an array of shape (1,84,8400)
+    """
+    model = registry.get(model_path)
+    outputs = model.run(["output0"], {"images":input})
+    return outputs[0]
+
+
+def infer(input, model_path=MODEL_PATH):
+    """
+    Function runs one input through the model, going through the
+    micro batcher when batching is enabled
+    :param input: Numpy array in a shape (1,3,width,height)
+    :param model_path: Path of the ONNX model to run
+    :return: Raw output of YOLOv8 network as an array of shape (1,84,8400)
+    """
+    if BATCHING_ENABLED:
+        # concurrent requests are stacked into one model run by the batcher
+        return get_batcher(model_path).submit(input).result()
+    return run_model(input, model_path)
+
+
+# function 2
+def prepare_input(buf, input_size=INPUT_SIZE):
+    """
+    Function used to convert input image to tensor,
+    required as an input to YOLOv8 object detection
+    network. The image is letterboxed into a float32 buffer
+    that is reused by every request on the same thread.
+    :param buf: Uploaded file input stream or a buffer from read_upload
+    :param input_size: Side of the square model input
+    :return: Numpy array in a shape (1,3,width,height) where 3 is number of color channels
+    """
+    return prepare_image(buf, input_size)
+
+
+def detection_key(image_hash, tiled=False, model_path=MODEL_PATH, settings=None):
+    """
+    Function builds the result cache key of a detection
+    :param image_hash: result_cache.content_hash of the uploaded file
+    :param tiled: Sliced inference instead of a single pass
+    :param model_path: Path of the ONNX model
+    :param settings: Dictionary from detection_settings, None for the deployment defaults
+    :return: Key for result_cache
+    """
+    # deployment settings that change the boxes are part of the key too, results stored before a change
+    # are not served after it
+    return result_key(image_hash, model_path, tiled=tiled, tile_size=TILE_SIZE, jpeg_draft=JPEG_DRAFT,
+                      **(settings or detection_settings()))
+
+
+def cached_detection(image_hash, tiled=False, model_path=MODEL_PATH, settings=None):
+    """
+    Function returns the stored result of an image already run with the same model and settings
+    :param image_hash: result_cache.content_hash of the uploaded file, None when unknown
+    :return: Array of detected objects in a format [[x1,y1,x2,y2,object_type,probability],..], None on a miss
+    """
+    if not RESULT_CACHE_ENABLED or image_hash is None:
+        return None
+    return result_cache.get(detection_key(image_hash, tiled, model_path, settings))
+
+
+# Function 1
+def detect_objects_on_image(stream, tiled=False, model_path=MODEL_PATH, image_hash=None, settings=None):
+    """
+    Function runs the detector over an image, or returns the cached result of the same file
+    :param stream: Uploaded file input stream or a buffer from read_upload
+    :param tiled: Split the image into overlapping tiles at model resolution
+    :param model_path: Path of the ONNX model to run
+    :param image_hash: result_cache.content_hash of the file, None to skip the result cache
+    :param settings: Dictionary from detection_settings, None for the deployment defaults
+    :return: Array of detected objects in a format [[x1,y1,x2,y2,object_type,probability],..]
+    """
+    settings = settings or detection_settings()
+    boxes = cached_detection(image_hash, tiled, model_path, settings)
+    if boxes is not None:
+        if METRICS_ENABLED:
+            DETECTIONS.observe(len(boxes))
+        return boxes
+
+    # the input size comes from the model itself so several exported resolutions can be served
+    input_size = registry.input_size(model_path)
+    if tiled:
+        # large captures are split into overlapping tiles at model resolution
+        with stage("decode"):
+            img = load_rgb_image(stream)
+            img.load()
+        # tiles are cut, run and merged together, the whole step counts as inference
+        with stage("inference"):
+            tile_boxes, scores, class_ids = detect_tiled(img, model_path, input_size,
+                                                         overlap=settings["tile_overlap"],
+                                                         max_candidates=MAX_NMS_CANDIDATES, **nms_settings(settings))
+        boxes = to_box_list(tile_boxes, scores, class_ids, yolo_classes)
+    else:
+        input, img_width, img_height = prepare_input(stream, input_size)
+        with stage("inference"):
+            output = infer(input, model_path)
+        boxes = process_output(output, img_width, img_height, input_size, **nms_settings(settings))
+
+    if METRICS_ENABLED:
+        DETECTIONS.observe(len(boxes))
+
+    if RESULT_CACHE_ENABLED and image_hash is not None:
+        result_cache.put(detection_key(image_hash, tiled, model_path, settings), boxes)
+    return boxes
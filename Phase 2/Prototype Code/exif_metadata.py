@@ -0,0 +1,265 @@
+import calendar
+import struct
+import time
+
+
+"""
+
+#######################################################################################################################################################################333
+IMAGE METADATA READER
+
+Reads the location, altitude and capture time of an image straight from its EXIF
+block. Only the few directories holding them are visited (IFD0, the GPS IFD and,
+when the GPS block has no time, the Exif IFD), thumbnails, maker notes and the
+pixel data are never touched. Rationals are read as integers and divided once,
+no tag is turned into a string to be parsed again.
+
+Supported containers: JPEG (APP1), TIFF, PNG (eXIf chunk) and WebP (EXIF chunk).
+"""
+
+# Bytes read from a file object, EXIF sits at the start and one APP1 segment is at most 64 KiB
+MAX_HEADER_BYTES = 256 * 1024
+
+EXIF_POINTER = 0x8769
+GPS_POINTER = 0x8825
+DATE_TIME = 0x0132
+DATE_TIME_ORIGINAL = 0x9003
+OFFSET_TIME_ORIGINAL = 0x9011
+
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+GPS_ALTITUDE_REF = 5
+GPS_ALTITUDE = 6
+GPS_TIME_STAMP = 7
+GPS_DATE_STAMP = 29
+
+# Size in bytes of one value of each TIFF field type
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+
+def find_exif(data):
+    """
+    Function locates the TIFF structure holding the EXIF data of an image
+    :param data: Bytes or memoryview of the start of the image
+    :return: memoryview of the TIFF structure, None when the image has no EXIF block
+    """
+    data = memoryview(data)
+
+    if data[:2] == b"\xff\xd8":
+        # JPEG, walk the marker segments up to the start of the pixel data
+        position = 2
+        while position + 4 <= len(data):
+            if data[position] != 0xFF:
+                return None
+            marker = data[position + 1]
+            if marker == 0xFF:
+                position += 1
+                continue
+            if marker == 0xDA or marker == 0xD9:
+                return None
+            length = struct.unpack(">H", data[position + 2:position + 4])[0]
+            segment = data[position + 4:position + 2 + length]
+            if marker == 0xE1 and segment[:6] == b"Exif\x00\x00":
+                return segment[6:]
+            position += 2 + length
+        return None
+
+    if data[:4] in (b"II*\x00", b"MM\x00*"):
+        return data
+
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        position = 8
+        while position + 8 <= len(data):
+            length, kind = struct.unpack(">I4s", data[position:position + 8])
+            if kind == b"eXIf":
+                return data[position + 8:position + 8 + length]
+            if kind in (b"IDAT", b"IEND"):
+                return None
+            position += 12 + length
+        return None
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        position = 12
+        while position + 8 <= len(data):
+            kind, length = struct.unpack("<4sI", data[position:position + 8])
+            if kind == b"EXIF":
+                chunk = data[position + 8:position + 8 + length]
+                return chunk[6:] if chunk[:6] == b"Exif\x00\x00" else chunk
+            position += 8 + length + (length & 1)
+        return None
+
+    return None
+
+
+class _Tiff:
+    # minimal reader of the TIFF structure of an EXIF block
+
+    def __init__(self, data):
+        self.data = data
+        self.endian = "<" if data[:2] == b"II" else ">"
+
+    def unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        end = offset + struct.calcsize(fmt)
+        if offset < 0 or end > len(self.data):
+            raise ValueError("EXIF entry out of bounds")
+        return struct.unpack(fmt, self.data[offset:end])
+
+    def first_ifd(self):
+        return self.unpack("I", 4)[0]
+
+    def entries(self, offset, wanted):
+        """
+        Function reads the entries of one IFD, only for the wanted tags
+        :return: Dictionary tag -> (type, count, offset of the value)
+        """
+        found = {}
+        count = self.unpack("H", offset)[0]
+        for index in range(count):
+            entry = offset + 2 + index * 12
+            tag, kind, values = self.unpack("HHI", entry)
+            if tag not in wanted or kind not in TYPE_SIZES:
+                continue
+            size = TYPE_SIZES[kind] * values
+            # values up to 4 bytes are stored in the entry itself, larger ones at an offset
+            value_offset = entry + 8 if size <= 4 else self.unpack("I", entry + 8)[0]
+            found[tag] = (kind, values, value_offset)
+            if len(found) == len(wanted):
+                break
+        return found
+
+    def value(self, entry):
+        """
+        Function decodes the value of an entry, rationals become floats
+        :return: A single value, or a tuple when the entry holds several, None when a rational has a zero denominator
+        """
+        kind, count, offset = entry
+        if kind == 2:
+            raw = bytes(self.data[offset:offset + count])
+            return raw.split(b"\x00", 1)[0].decode("ascii", "replace").strip()
+        if kind in (5, 10):
+            pairs = self.unpack(("II" if kind == 5 else "ii") * count, offset)
+            values = []
+            for numerator, denominator in zip(pairs[::2], pairs[1::2]):
+                if denominator == 0:
+                    return None
+                values.append(numerator / denominator)
+        else:
+            fmt = {1: "B", 3: "H", 4: "I", 6: "b", 7: "B", 8: "h", 9: "i", 11: "f", 12: "d"}[kind]
+            values = list(self.unpack(fmt * count, offset))
+        return values[0] if count == 1 else tuple(values)
+
+
+def convert_dms_to_dd(dms):
+    # Function to convert degrees, minutes, seconds to decimal degrees
+    degrees, minutes, seconds = dms
+    return degrees + minutes / 60.0 + seconds / 3600.0
+
+
+def _exif_time(text, offset=None):
+    # "YYYY:MM:DD HH:MM:SS" in camera local time, shifted to UTC when the offset "+HH:MM" is known
+    try:
+        seconds = calendar.timegm(time.strptime(text, "%Y:%m:%d %H:%M:%S"))
+    except (TypeError, ValueError):
+        return None
+    if offset and len(offset) == 6 and offset[0] in "+-":
+        try:
+            shift = int(offset[1:3]) * 3600 + int(offset[4:6]) * 60
+        except ValueError:
+            return seconds
+        seconds -= shift if offset[0] == "+" else -shift
+    return float(seconds)
+
+
+def read_metadata(data):
+    """
+    Function reads the GPS position, altitude and capture time of an image
+    :param data: Bytes or memoryview holding at least the start of the image
+    :return: Dictionary with "latitude" and "longitude" in decimal degrees, "altitude" in meters and
+             "captured_at" as Unix time, each None when the image does not carry it
+    """
+    metadata = {"latitude": None, "longitude": None, "altitude": None, "captured_at": None}
+    exif = find_exif(data)
+    if exif is None or len(exif) < 8:
+        return metadata
+
+    try:
+        tiff = _Tiff(exif)
+        ifd0 = tiff.entries(tiff.first_ifd(), {GPS_POINTER, EXIF_POINTER, DATE_TIME})
+
+        if GPS_POINTER in ifd0:
+            gps = tiff.entries(tiff.value(ifd0[GPS_POINTER]), {
+                GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE,
+                GPS_ALTITUDE_REF, GPS_ALTITUDE, GPS_TIME_STAMP, GPS_DATE_STAMP})
+
+            latitude = tiff.value(gps[GPS_LATITUDE]) if GPS_LATITUDE in gps else None
+            longitude = tiff.value(gps[GPS_LONGITUDE]) if GPS_LONGITUDE in gps else None
+            if (GPS_LATITUDE_REF in gps and GPS_LONGITUDE_REF in gps and
+                    isinstance(latitude, tuple) and len(latitude) == 3 and
+                    isinstance(longitude, tuple) and len(longitude) == 3):
+                metadata["latitude"] = convert_dms_to_dd(latitude)
+                metadata["longitude"] = convert_dms_to_dd(longitude)
+                # Adjust the sign of latitude and longitude based on their reference
+                if tiff.value(gps[GPS_LATITUDE_REF]) == "S":
+                    metadata["latitude"] = -metadata["latitude"]
+                if tiff.value(gps[GPS_LONGITUDE_REF]) == "W":
+                    metadata["longitude"] = -metadata["longitude"]
+
+            if GPS_ALTITUDE in gps:
+                altitude = tiff.value(gps[GPS_ALTITUDE])
+                if isinstance(altitude, float):
+                    # reference 1 means below sea level
+                    below = GPS_ALTITUDE_REF in gps and tiff.value(gps[GPS_ALTITUDE_REF]) == 1
+                    metadata["altitude"] = -altitude if below else altitude
+
+            # GPS date and time are in UTC
+            if GPS_DATE_STAMP in gps and GPS_TIME_STAMP in gps:
+                clock = tiff.value(gps[GPS_TIME_STAMP])
+                captured_at = _exif_time(f"{tiff.value(gps[GPS_DATE_STAMP])} 00:00:00")
+                if captured_at is not None and isinstance(clock, tuple) and len(clock) == 3:
+                    metadata["captured_at"] = captured_at + clock[0] * 3600 + clock[1] * 60 + clock[2]
+
+        if metadata["captured_at"] is None:
+            # camera clock, original capture time first and the file time as last resort
+            if EXIF_POINTER in ifd0:
+                exif_ifd = tiff.entries(tiff.value(ifd0[EXIF_POINTER]), {DATE_TIME_ORIGINAL, OFFSET_TIME_ORIGINAL})
+                if DATE_TIME_ORIGINAL in exif_ifd:
+                    offset = tiff.value(exif_ifd[OFFSET_TIME_ORIGINAL]) if OFFSET_TIME_ORIGINAL in exif_ifd else None
+                    metadata["captured_at"] = _exif_time(tiff.value(exif_ifd[DATE_TIME_ORIGINAL]), offset)
+            if metadata["captured_at"] is None and DATE_TIME in ifd0:
+                metadata["captured_at"] = _exif_time(tiff.value(ifd0[DATE_TIME]))
+    except (ValueError, struct.error) as e:
+        # broken EXIF, keep whatever was read before the error
+        print("Error reading image metadata:", e)
+
+    return metadata
+
+
+def read_image_metadata(source):
+    """
+    Function reads the metadata of an image given as a buffer or as a file object
+    :param source: bytes, memoryview or mmap (read in place) or a seekable file object (only its header is read)
+    :return: Same dictionary as read_metadata
+    """
+    try:
+        view = memoryview(source)
+    except TypeError:
+        return read_file_metadata(source)
+    return read_metadata(view)
+
+
+def read_file_metadata(file):
+    """
+    Function reads the metadata of an image file object from its start, only the header is read
+    :param file: Seekable file object, its position is restored
+    :return: Same dictionary as read_metadata
+    """
+    position = file.tell()
+    try:
+        file.seek(0)
+        header = file.read(MAX_HEADER_BYTES)
+    finally:
+        file.seek(position)
+    return read_metadata(header)
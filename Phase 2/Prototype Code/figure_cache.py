@@ -0,0 +1,101 @@
+import hashlib
+import importlib.metadata
+import importlib.util
+import os
+import threading
+from collections import OrderedDict
+
+from metrics import cache_lookup
+
+
+"""
+
+#######################################################################################################################################################################333
+VISUALIZATION DATA CACHE
+
+The visualize page draws its map and charts in the browser with the plotly.js
+bundle of the installed plotly package (PLOTLY_JS_PATH), the server only sends
+the data. The serialized data is kept per user next to the data version it was
+built from and reused until that version changes, the same version is sent as
+the ETag so a browser holding the current data gets a 304 without any query.
+"""
+
+# Number of users whose data is kept, least recently used ones are dropped first
+FIGURE_CACHE_SIZE = int(os.environ.get("REVA_FIGURE_CACHE_SIZE", "128"))
+
+# plotly.js bundle shipped with the plotly package, served by the app instead of a CDN copy of unknown version.
+# The package is only located, importing it would load its Python side for nothing
+PLOTLY_JS_PATH = os.path.join(importlib.util.find_spec("plotly").submodule_search_locations[0],
+                              "package_data", "plotly.min.js")
+PLOTLY_VERSION = importlib.metadata.version("plotly")
+
+
+class FigureCache:
+    """
+    Thread safe LRU cache of rendered values, an entry is only returned while its version is current
+    """
+
+    def __init__(self, max_entries=FIGURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, version, render):
+        """
+        Function returns the cached value for a key or renders and stores it
+        :param key: Hashable key, e.g. (db_path, user_id)
+        :param version: Hashable version of the data behind the value, a different version renders again
+        :param render: Called without arguments to build the value on a miss
+        :return: The cached or newly rendered value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                cache_lookup("visualize", True)
+                return entry[1]
+        cache_lookup("visualize", False)
+
+        # render outside the lock, other users are not held up by a slow query
+        value = render()
+
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Function drops the entry of a key, or every entry
+        :param key: Key to drop, None for all of them
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+def data_etag(*parts):
+    """
+    Function builds a strong ETag from the values identifying a version of the data
+    :param parts: Values such as the database path, the user id and the user's running totals
+    :return: ETag value without quotes
+    """
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def image_columns(rows):
+    """
+    Function turns per image summary rows into columns, one list per field
+    :param rows: List of tuples (filename, count, latitude, longitude)
+    :return: Dictionary with the lists "filename", "count", "latitude" and "longitude"
+    """
+    filenames, counts, latitudes, longitudes = (list(column) for column in zip(*rows)) if rows else ([], [], [], [])
+    return {"filename": filenames, "count": counts, "latitude": latitudes, "longitude": longitudes}
+
+
+# Shared cache for the whole process
+figure_cache = FigureCache()
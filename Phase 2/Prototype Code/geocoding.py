@@ -0,0 +1,272 @@
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from db import get_connection
+from metrics import stage, cache_lookup
+
+
+"""
+
+#######################################################################################################################################################################333
+REVERSE GEOCODING
+
+Turns the coordinates of an image into an address. Lookups go through an on-disk
+cache keyed by coordinates rounded to GEOCODE_PRECISION decimals, so repeat surveys
+of the same place never leave the process, and identical lookups running at the
+same time share one provider call. Providers are tried in order until one knows
+the place:
+
+    gazetteer   nearest entry of a local CSV file, works offline
+    nominatim   OpenStreetMap Nominatim through geopy, at most one call per second
+
+    REVA_GEOCODERS=gazetteer,nominatim REVA_GAZETTEER=places.csv
+
+The gazetteer CSV needs a header with latitude, longitude, address, country and postcode.
+"""
+
+# Decimals kept from the coordinates, 4 decimals is about 11 m
+GEOCODE_PRECISION = int(os.environ.get("REVA_GEOCODE_PRECISION", "4"))
+
+# SQLite file holding the cached addresses
+GEOCODE_CACHE_PATH = os.environ.get("REVA_GEOCODE_CACHE", "geocode_cache.db")
+
+# Providers tried in order, see PROVIDERS
+GEOCODERS = [name.strip() for name in os.environ.get("REVA_GEOCODERS", "nominatim").split(",") if name.strip()]
+
+GAZETTEER_PATH = os.environ.get("REVA_GAZETTEER", "")
+
+# Gazetteer entries further away than this are not considered a match
+GAZETTEER_MAX_DISTANCE_KM = float(os.environ.get("REVA_GAZETTEER_MAX_KM", "5"))
+
+# Nominatim usage policy allows one request per second
+NOMINATIM_MIN_INTERVAL = float(os.environ.get("REVA_NOMINATIM_MIN_INTERVAL", "1"))
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def location_from_raw(address, raw_address):
+    """
+    Function builds the location dictionary returned by the providers
+    :param address: Full address as a string
+    :param raw_address: Dictionary of address parts, e.g. the "address" of a Nominatim result
+    :return: Dictionary with "address", "country" and "postcode"
+    """
+    return {
+        "address": address,
+        "country": raw_address.get("country"),
+        "postcode": raw_address.get("postcode")
+    }
+
+
+class NominatimGeocoder:
+    """
+    Online provider using OpenStreetMap Nominatim, calls are spaced by min_interval seconds
+    """
+
+    def __init__(self, user_agent="object-detection-app", min_interval=NOMINATIM_MIN_INTERVAL, timeout=10):
+        self.user_agent = user_agent
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self._geolocator = None
+        self._lock = threading.Lock()
+        self._last_call = 0.0
+
+    def reverse(self, latitude, longitude):
+        """
+        Function looks up the address of a point
+        :return: Location dictionary, None when Nominatim has no address there
+        """
+        with self._lock:
+            if self._geolocator is None:
+                from geopy.geocoders import Nominatim
+                self._geolocator = Nominatim(user_agent=self.user_agent, timeout=self.timeout)
+
+            wait = self._last_call + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                location = self._geolocator.reverse(f"{latitude}, {longitude}", exactly_one=True)
+            finally:
+                self._last_call = time.monotonic()
+
+        if not location:
+            return None
+        return location_from_raw(location.address, location.raw.get("address", {}))
+
+
+class GazetteerGeocoder:
+    """
+    Offline provider returning the nearest entry of a CSV gazetteer within max_distance_km
+    """
+
+    def __init__(self, path=GAZETTEER_PATH, max_distance_km=GAZETTEER_MAX_DISTANCE_KM):
+        self.path = path
+        self.max_distance_km = max_distance_km
+        self._points = None
+        self._places = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._points is None:
+                places = []
+                coordinates = []
+                with open(self.path, newline="", encoding="utf-8") as file:
+                    for row in csv.DictReader(file):
+                        coordinates.append((float(row["latitude"]), float(row["longitude"])))
+                        places.append(location_from_raw(row["address"], row))
+                self._places = places
+                self._points = np.radians(np.array(coordinates, dtype=np.float64).reshape(-1, 2))
+        return self._points, self._places
+
+    def reverse(self, latitude, longitude):
+        """
+        Function looks up the nearest gazetteer entry of a point
+        :return: Location dictionary, None when no entry is close enough
+        """
+        points, places = self._load()
+        if len(places) == 0:
+            return None
+
+        # haversine distance to every entry at once
+        lat, lon = np.radians(latitude), np.radians(longitude)
+        a = (np.sin((points[:, 0] - lat) / 2) ** 2 +
+             np.cos(lat) * np.cos(points[:, 0]) * np.sin((points[:, 1] - lon) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+        nearest = int(distances.argmin())
+        if distances[nearest] > self.max_distance_km:
+            return None
+        return dict(places[nearest])
+
+
+# Provider names accepted in REVA_GEOCODERS
+PROVIDERS = {
+    "nominatim": lambda user_agent: NominatimGeocoder(user_agent),
+    "gazetteer": lambda user_agent: GazetteerGeocoder(),
+}
+
+
+class ReverseGeocoder:
+    """
+    Cached and coalesced reverse geocoding over an ordered list of providers
+    """
+
+    def __init__(self, providers, cache_path=GEOCODE_CACHE_PATH, precision=GEOCODE_PRECISION):
+        """
+        :param providers: Objects with a reverse(latitude, longitude) method returning a location dictionary or None
+        :param cache_path: SQLite file of the cache, None to not cache
+        :param precision: Decimals of the coordinates used as cache key
+        """
+        self.providers = list(providers)
+        self.cache_path = cache_path
+        self.precision = precision
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._cache_ready = False
+
+    def _cache(self):
+        connection = get_connection(self.cache_path)
+        if not self._cache_ready:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS geocode_cache (
+                    latitude TEXT NOT NULL,
+                    longitude TEXT NOT NULL,
+                    location TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (latitude, longitude)
+                ) WITHOUT ROWID
+            """)
+            self._cache_ready = True
+        return connection
+
+    def key(self, latitude, longitude):
+        """
+        Function rounds a point to the cache precision
+        :return: Tuple of the rounded latitude and longitude as strings
+        """
+        return f"{latitude:.{self.precision}f}", f"{longitude:.{self.precision}f}"
+
+    def _lookup(self, latitude, longitude):
+        # first provider knowing the place wins, a failing provider is skipped
+        failed = False
+        for provider in self.providers:
+            try:
+                location = provider.reverse(latitude, longitude)
+            except Exception as e:
+                print("Error reverse geocoding with", type(provider).__name__ + ":", e)
+                failed = True
+                continue
+            if location:
+                return location, True
+        # "not found" is only worth remembering when every provider actually answered
+        return None, not failed
+
+    def reverse(self, latitude, longitude):
+        """
+        Function returns the address of a point
+        :param latitude: Latitude in decimal degrees
+        :param longitude: Longitude in decimal degrees
+        :return: Dictionary with "address", "country" and "postcode", None when no provider knows the place
+        """
+        with stage("geocode"):
+            return self._reverse(latitude, longitude)
+
+    def _reverse(self, latitude, longitude):
+        key = self.key(latitude, longitude)
+
+        if self.cache_path:
+            row = self._cache().execute(
+                "SELECT location FROM geocode_cache WHERE latitude = ? AND longitude = ?", key
+            ).fetchone()
+            cache_lookup("geocode", row is not None)
+            if row:
+                return json.loads(row[0])
+
+        # the first caller for a key does the lookup, the others wait for its result
+        with self._lock:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            location, cacheable = self._lookup(*(float(value) for value in key))
+            if cacheable and self.cache_path:
+                connection = self._cache()
+                with connection:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO geocode_cache (latitude, longitude, location, created_at) VALUES (?, ?, ?, ?)",
+                        key + (json.dumps(location), time.time())
+                    )
+            future.set_result(location)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+        return location
+
+
+def create_reverse_geocoder(user_agent="object-detection-app", names=None, cache_path=GEOCODE_CACHE_PATH):
+    """
+    Function builds the reverse geocoder configured by REVA_GEOCODERS
+    :param user_agent: User agent sent to online providers
+    :param names: Provider names in order, defaults to GEOCODERS
+    :param cache_path: SQLite file of the cache, None to not cache
+    :return: ReverseGeocoder
+    """
+    names = GEOCODERS if names is None else names
+    unknown = [name for name in names if name not in PROVIDERS]
+    if unknown:
+        raise ValueError(f"Unknown geocoders: {', '.join(unknown)}")
+    return ReverseGeocoder([PROVIDERS[name](user_agent) for name in names], cache_path)
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from detection import infer, process_output, cached_detection, detection_key, detection_settings, nms_settings
+from model_registry import registry, MODEL_PATH
+from preprocess import load_scaled_image, write_letterboxed
+from result_cache import result_cache, content_hash, RESULT_CACHE_ENABLED
+from metrics import stage
+
+
+"""
+
+#######################################################################################################################################################################333
+BULK INGESTION
+
+Runs a whole survey (ZIP archive or folder of images) through the detector.
+Decoding, inference and persistence are separate stages running at the same
+time, so the CPU stays busy decoding the next images while the model runs.
+Each image's result is produced as soon as it is stored. Images already run with
+the same model come from the result cache and skip decoding and inference.
+
+    python ingest.py survey.zip --user 1 > results.ndjson
+"""
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Threads per stage and images held in memory at once
+DECODE_WORKERS = int(os.environ.get("REVA_INGEST_DECODE_WORKERS", "2"))
+INFER_WORKERS = int(os.environ.get("REVA_INGEST_INFER_WORKERS", "2"))
+MAX_IN_FLIGHT = int(os.environ.get("REVA_INGEST_MAX_IN_FLIGHT", "8"))
+
+
+def iter_zip_images(file):
+    """
+    Function reads the images of a ZIP archive one at a time
+    :param file: Path or seekable file object of the archive, file objects are closed when done
+    :return: Generator of (filename, bytes)
+    """
+    try:
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                yield os.path.basename(info.filename), archive.read(info)
+    finally:
+        if hasattr(file, "close"):
+            file.close()
+
+
+def spool_upload(stream):
+    """
+    Function copies an uploaded file to a temporary file owned by the caller,
+    Werkzeug closes the upload once the view returns, before a streamed response is read
+    :param stream: Uploaded file input stream
+    :return: Temporary file positioned at the start, deleted when closed
+    """
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def iter_directory_images(path):
+    """
+    Function reads the images of a folder and its sub folders one at a time
+    :param path: Folder holding the images
+    :return: Generator of (filename, bytes)
+    """
+    for root, _, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(root, name), "rb") as file:
+                    yield name, file.read()
+
+
+def _decode(filename, data, locate, model_path, input_size, settings):
+    # stage 1: metadata and pixels, the tensor is private to this image since it changes threads
+    geolocation = locate(data)
+    decoded = {"filename": filename, "latitude": geolocation["latitude"], "longitude": geolocation["longitude"],
+               "captured_at": geolocation.get("captured_at"),
+               "image_hash": content_hash(data) if RESULT_CACHE_ENABLED else None}
+
+    boxes = cached_detection(decoded["image_hash"], model_path=model_path, settings=settings)
+    if boxes is not None:
+        # image seen before, no pixels to decode
+        decoded["boxes"] = boxes
+        return decoded
+
+    with stage("decode"):
+        img, img_width, img_height = load_scaled_image(data, input_size)
+        img.load()
+    with stage("preprocess"):
+        tensor = np.empty((1, 3, input_size, input_size), dtype=np.float32)
+        write_letterboxed(img, tensor[0], input_size, (img_width, img_height))
+    decoded.update(tensor=tensor, width=img_width, height=img_height)
+    return decoded
+
+
+def _infer(decoded, model_path, input_size, settings):
+    # stage 2: model and postprocessing, parallel calls are batched together by the micro batcher
+    with stage("inference"):
+        output = infer(decoded.pop("tensor"), model_path)
+    decoded["boxes"] = process_output(output, decoded.pop("width"), decoded.pop("height"), input_size,
+                                      **nms_settings(settings))
+    if decoded["image_hash"] is not None:
+        result_cache.put(detection_key(decoded["image_hash"], model_path=model_path, settings=settings),
+                         decoded["boxes"])
+    return decoded
+
+
+def ingest_images(images, locate, save, model_path=MODEL_PATH, decode_workers=DECODE_WORKERS,
+                  infer_workers=INFER_WORKERS, max_in_flight=MAX_IN_FLIGHT, settings=None):
+    """
+    Function runs the detection pipeline over many images and yields each result once it is stored
+    :param images: Iterable of (filename, bytes)
+    :param locate: Called as locate(data) with the bytes of the image, returns {"latitude": .., "longitude": .., "captured_at": ..} or raises ValueError
+    :param save: Called as save(filename, boxes, latitude, longitude, captured_at, image_hash) to persist one image
+    :param model_path: Path of the ONNX model to run
+    :param decode_workers: Threads decoding images
+    :param infer_workers: Threads running the model
+    :param max_in_flight: Maximum number of images decoded but not yet stored
+    :param settings: Dictionary from detection.detection_settings, None for the deployment defaults
+    :return: Generator of dictionaries, one per image, in completion order
+    """
+    input_size = registry.input_size(model_path)
+    settings = settings or detection_settings()
+    results = queue.Queue()
+    slots = threading.BoundedSemaphore(max_in_flight)
+    decode_pool = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="ingest-decode")
+    infer_pool = ThreadPoolExecutor(max_workers=infer_workers, thread_name_prefix="ingest-infer")
+    stop = threading.Event()
+
+    def fail(filename, error):
+        results.put({"filename": filename, "status": "error", "error": str(error)})
+
+    def on_inferred(filename, future):
+        try:
+            results.put(future.result())
+        except Exception as e:
+            fail(filename, e)
+
+    def on_decoded(filename, future):
+        try:
+            decoded = future.result()
+        except Exception as e:
+            fail(filename, e)
+            return
+        if "boxes" in decoded:
+            # answered by the result cache
+            results.put(decoded)
+            return
+        infer_pool.submit(_infer, decoded, model_path, input_size, settings).add_done_callback(
+            lambda future: on_inferred(filename, future))
+
+    def feed():
+        count = 0
+        try:
+            for filename, data in images:
+                slots.acquire()
+                if stop.is_set():
+                    break
+                count += 1
+                decode_pool.submit(_decode, filename, data, locate, model_path, input_size, settings).add_done_callback(
+                    lambda future, filename=filename: on_decoded(filename, future))
+        except Exception as e:
+            # unreadable archive, report it as a last entry
+            slots.acquire()
+            count += 1
+            fail(None, e)
+        results.put(count)
+
+    feeder = threading.Thread(target=feed, name="ingest-feed", daemon=True)
+    feeder.start()
+
+    total = None
+    done = 0
+    try:
+        while total is None or done < total:
+            item = results.get()
+            if isinstance(item, int):
+                total = item
+                continue
+
+            # stage 3: persistence runs on the consuming thread, one image at a time
+            if item.get("status") != "error":
+                try:
+                    save(item["filename"], item["boxes"], item["latitude"], item["longitude"], item["captured_at"],
+                         item.pop("image_hash"))
+                    item["status"] = "ok"
+                    item["count"] = len(item["boxes"])
+                except Exception as e:
+                    item = {"filename": item["filename"], "status": "error", "error": str(e)}
+            done += 1
+            slots.release()
+            yield item
+    finally:
+        # client went away or we are done, let the feeder exit and the pools drain
+        stop.set()
+        try:
+            slots.release()
+        except ValueError:
+            pass
+        decode_pool.shutdown(wait=False)
+        infer_pool.shutdown(wait=False)
+
+
+def to_ndjson(results):
+    """
+    Function serializes results as newline delimited JSON
+    :param results: Iterable of dictionaries
+    :return: Generator of lines
+    """
+    for result in results:
+        yield json.dumps(result) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run detection over a ZIP archive or a folder of images")
+    parser.add_argument("source", help="ZIP archive or folder of images")
+    parser.add_argument("--user", type=int, required=True, help="id of the user owning the detections")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--conf", type=float, help="confidence threshold, defaults to REVA_CONF_THRESHOLD")
+    parser.add_argument("--iou", type=float, help="NMS IoU threshold, defaults to REVA_IOU_THRESHOLD")
+    parser.add_argument("--max-det", type=int, help="boxes kept per image, 0 for no limit, defaults to REVA_MAX_DETECTIONS")
+    args = parser.parse_args()
+    settings = detection_settings({name: value for name, value in
+                                   (("conf", args.conf), ("iou", args.iou), ("max_det", args.max_det)) if value is not None})
+
+    # the app module owns the database setup and the metadata reader, the model is loaded by ingest_images
+    from app import init_app, get_image_geolocation, save_detections
+    init_app(preload=False)
+
+    if os.path.isdir(args.source):
+        images = iter_directory_images(args.source)
+    else:
+        images = iter_zip_images(args.source)
+
+    def save(filename, boxes, latitude, longitude, captured_at, image_hash):
+        save_detections(args.user, filename, boxes, latitude, longitude, captured_at, image_hash)
+
+    for line in to_ndjson(ingest_images(images, get_image_geolocation, save, args.model, settings=settings)):
+        print(line, end="", flush=True)
+
+
+if __name__ == "__main__":
+    main()
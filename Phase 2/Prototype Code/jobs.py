@@ -0,0 +1,192 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from db import get_connection
+
+
+"""
+
+#######################################################################################################################################################################333
+ASYNCHRONOUS DETECTION JOBS
+
+Uploads are accepted straight away and handed to a local pool of worker
+processes, the HTTP thread only returns a job id. Job state and results are
+kept in the database so finished jobs survive a restart. A file already run with
+the same model and settings is answered from the result cache without a worker.
+"""
+
+# Number of worker processes running detections
+JOB_WORKERS = int(os.environ.get("REVA_JOB_WORKERS", "1"))
+
+JOB_QUEUED = "queued"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def fail_interrupted_jobs(db_path):
+    # the detection_job table itself is created by migrations.py
+    connection = get_connection(db_path)
+    cursor = connection.cursor()
+
+    # jobs still pending from a server process that no longer exists cannot be resumed, their upload is gone.
+    # Runs only from app.init_app (create_app, the ingest CLI), pending jobs of other live servers are left alone.
+    cursor.execute("SELECT id, server_pid FROM detection_job WHERE status = ?", (JOB_QUEUED,))
+    for job_id, server_pid in cursor.fetchall():
+        if not _process_alive(server_pid):
+            cursor.execute(
+                "UPDATE detection_job SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (JOB_FAILED, "Interrupted by a server restart", time.time(), job_id)
+            )
+    connection.commit()
+
+
+def _process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists but belongs to another user
+        return True
+    return True
+
+
+def _init_worker():
+    # load the model once per worker process, not once per job
+    from model_selection import MODEL_PATHS
+    from model_registry import registry
+    for model_path in MODEL_PATHS:
+        registry.preload(model_path)
+
+
+def _run_detection(data, tiled, model_path, image_hash, settings):
+    # runs inside a worker process, the result is also stored in the shared result cache
+    from detection import detect_objects_on_image
+    return detect_objects_on_image(data, tiled=tiled, model_path=model_path, image_hash=image_hash, settings=settings)
+
+
+class JobQueue:
+    """
+    Runs detections in a process pool and records every job in the detection_job table
+    """
+
+    def __init__(self, db_path, on_result=None, workers=JOB_WORKERS):
+        """
+        :param db_path: Path of the SQLite database
+        :param on_result: Called as on_result(user_id, filename, boxes, latitude, longitude, captured_at, image_hash)
+                          when a job finishes, used to store its detections
+        :param workers: Number of worker processes
+        """
+        self.db_path = db_path
+        self.on_result = on_result
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn so workers start from a clean interpreter instead of a fork of the web server
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=_init_worker)
+            return self._executor
+
+    def pending(self):
+        """
+        Function returns the number of jobs of this process not finished yet
+        """
+        return self._pending
+
+    def _execute(self, query, params):
+        connection = get_connection(self.db_path)
+        with connection:
+            connection.execute(query, params)
+
+    def submit(self, user_id, filename, data, latitude, longitude, tiled=False, model_path=None, captured_at=None,
+               image_hash=None, settings=None):
+        """
+        Function queues a detection job
+        :param user_id: Owner of the job
+        :param filename: Name of the uploaded file
+        :param data: Bytes of the uploaded image
+        :param latitude: Latitude read from the image metadata
+        :param longitude: Longitude read from the image metadata
+        :param tiled: Run sliced inference instead of a single pass
+        :param model_path: Path of the ONNX model to run
+        :param captured_at: Capture time read from the image metadata, passed on to on_result
+        :param image_hash: result_cache.content_hash of the file, None to skip the result cache
+        :param settings: Dictionary from detection.detection_settings, None for the deployment defaults
+        :return: Id of the new job
+        """
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO detection_job (id, user_id, filename, status, latitude, longitude, created_at, server_pid) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, user_id, filename, JOB_QUEUED, latitude, longitude, time.time(), os.getpid())
+        )
+
+        with self._lock:
+            self._pending += 1
+
+        from detection import cached_detection, detection_settings
+        settings = settings or detection_settings()
+        boxes = cached_detection(image_hash, tiled, model_path, settings)
+        if boxes is not None:
+            # seen before, finish the job on this thread
+            future = Future()
+            future.set_result(boxes)
+        else:
+            future = self._get_executor().submit(_run_detection, data, tiled, model_path, image_hash, settings)
+        future.add_done_callback(
+            lambda future: self._finish(job_id, user_id, filename, latitude, longitude, captured_at, image_hash, future))
+        return job_id
+
+    def _finish(self, job_id, user_id, filename, latitude, longitude, captured_at, image_hash, future):
+        with self._lock:
+            self._pending -= 1
+        try:
+            boxes = future.result()
+            if self.on_result:
+                self.on_result(user_id, filename, boxes, latitude, longitude, captured_at, image_hash)
+        except Exception as e:
+            print("Error running detection job:", e)
+            self._execute("UPDATE detection_job SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                          (JOB_FAILED, str(e), time.time(), job_id))
+            return
+
+        self._execute("UPDATE detection_job SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                      (JOB_DONE, json.dumps(boxes), time.time(), job_id))
+
+    def get(self, job_id, user_id):
+        """
+        Function returns a job of a user
+        :param job_id: Id of the job
+        :param user_id: Owner of the job
+        :return: Dictionary with the job state and its boxes once done, None if not found
+        """
+        row = get_connection(self.db_path).execute(
+            "SELECT id, filename, status, latitude, longitude, result, error, created_at, finished_at FROM detection_job WHERE id = ? AND user_id = ?",
+            (job_id, user_id)
+        ).fetchone()
+
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "filename": row[1],
+            "status": row[2],
+            "latitude": row[3],
+            "longitude": row[4],
+            "boxes": json.loads(row[5]) if row[5] else None,
+            "error": row[6],
+            "created_at": row[7],
+            "finished_at": row[8],
+        }
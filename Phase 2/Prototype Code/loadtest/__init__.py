@@ -0,0 +1,25 @@
+"""
+
+#######################################################################################################################################################################333
+HTTP LOAD TEST
+
+Drives the app over HTTP the way browsers do: every virtual user logs in and
+then keeps picking a scenario (upload to /detect, /db_data, /visualize with
+its data request, /get_location) by weight, for a fixed duration. Latency and
+status of every request are recorded per endpoint and reported as JSON with
+throughput and p50/p95/p99.
+
+By default the app is started under waitress in a scratch folder with the
+stand-in model of the benchmark package and an offline gazetteer in place of
+Nominatim, so nothing leaves the machine and the working copy is not touched.
+
+    python -m loadtest --threads 8 --users 16 --duration 60
+    python -m loadtest --url http://staging:8080 --email load@test --password secret
+
+Run from the Prototype Code folder.
+"""
+
+from loadtest.client import HttpSession, encode_multipart
+from loadtest.runner import run_load, summarize_load
+from loadtest.scenarios import SCENARIOS, build_fixtures
+from loadtest.server import spawn_server
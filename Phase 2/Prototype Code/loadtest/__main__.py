@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import uuid
+
+from benchmark.standin import build_standin_model
+from loadtest.client import HttpSession
+from loadtest.runner import run_load
+from loadtest.scenarios import build_fixtures, CENTRE, DEFAULT_WEIGHTS
+from loadtest.server import spawn_server, write_gazetteer
+
+
+def parse_weights(text):
+    weights = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def register(base_url, name, email, password):
+    # /register redirects to /login on success
+    status, _, _ = HttpSession(base_url).post_form("/register", {"name": name, "email": email, "password": password})
+    if status != 302:
+        raise RuntimeError(f"Registering the load test user failed with status {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app over HTTP")
+    parser.add_argument("--url", help="running server to test, by default one is started under waitress")
+    parser.add_argument("--email", help="existing account on --url, a new one is registered otherwise")
+    parser.add_argument("--password", default="load-test")
+    parser.add_argument("--threads", type=int, default=8, help="waitress threads of the started server")
+    parser.add_argument("--model", help="ONNX model of the started server, defaults to the benchmark stand-in")
+    parser.add_argument("--users", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of load before measuring")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds between two steps of a user")
+    parser.add_argument("--weights", type=parse_weights, default=DEFAULT_WEIGHTS,
+                        help="scenario weights, e.g. detect=1,db_data=4,visualize=2,get_location=4,login=1")
+    parser.add_argument("--images", type=int, default=20, help="distinct images uploaded to /detect")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this file instead of stdout")
+    args = parser.parse_args()
+
+    fixtures = build_fixtures(images=args.images, seed=args.seed)
+    with tempfile.TemporaryDirectory(prefix="reva-loadtest-") as workdir:
+        process = None
+        try:
+            base_url = args.url
+            if base_url is None:
+                model_path = args.model or build_standin_model(os.path.join(workdir, "standin.onnx"))
+                gazetteer_path = write_gazetteer(os.path.join(workdir, "gazetteer.csv"), CENTRE)
+                process, base_url = spawn_server(workdir, model_path, gazetteer_path, args.threads)
+
+            fixtures["email"] = args.email or f"load-{uuid.uuid4().hex[:8]}@example.com"
+            fixtures["password"] = args.password
+            if args.email is None:
+                register(base_url, "Load Test", fixtures["email"], fixtures["password"])
+
+            report = run_load(base_url, fixtures, args.weights, args.users, args.duration, args.warmup,
+                              args.think_time, args.seed)
+            report["server_threads"] = args.threads if args.url is None else None
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import http.client
+import time
+import uuid
+from urllib.parse import urlencode, urlsplit
+
+
+"""
+
+#######################################################################################################################################################################333
+HTTP CLIENT
+
+One keep-alive connection and one cookie jar per virtual user, on the standard
+library only so the load generator adds no dependency and little overhead.
+"""
+
+
+def encode_multipart(fields, files):
+    """
+    Function encodes a multipart/form-data body
+    :param fields: Dictionary of form values
+    :param files: Dictionary name -> (filename, bytes, content type)
+    :return: Tuple (body bytes, content type header)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, content_type) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode())
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class HttpSession:
+    """
+    Keep-alive connection to the app with its cookies, every request is timed and handed to record
+    """
+
+    def __init__(self, base_url, record=None, timeout=60):
+        """
+        :param base_url: e.g. "http://127.0.0.1:8080"
+        :param record: Called as record(endpoint, status, seconds) after every request, status 0 on a network error
+        :param timeout: Socket timeout in seconds
+        """
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.https = url.scheme == "https"
+        self.record = record
+        self.timeout = timeout
+        self.cookies = {}
+        # last ETag seen per path, for conditional requests
+        self.etags = {}
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            factory = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self._connection = factory(self.host, self.port, timeout=self.timeout)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def request(self, method, path, endpoint=None, body=None, headers=None):
+        """
+        Function sends one request and reads the whole response
+        :param method: HTTP method
+        :param path: Path and query
+        :param endpoint: Name the timing is recorded under, defaults to the path
+        :param body: Request body bytes
+        :param headers: Extra request headers
+        :return: Tuple (status, response headers, body bytes), status 0 when the request failed
+        """
+        headers = dict(headers or {})
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+
+        start = time.perf_counter()
+        try:
+            connection = self._connect()
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            status = response.status
+            response_headers = response.getheaders()
+        except (OSError, http.client.HTTPException):
+            # the server dropped the connection, a fresh one is opened for the next request
+            self.close()
+            status, response_headers, data = 0, [], b""
+        elapsed = time.perf_counter() - start
+
+        for name, value in response_headers:
+            if name.lower() == "set-cookie":
+                cookie = value.split(";", 1)[0]
+                if "=" in cookie:
+                    key, cookie_value = (part.strip() for part in cookie.split("=", 1))
+                    # an empty value is the server deleting the cookie, e.g. on logout
+                    if cookie_value:
+                        self.cookies[key] = cookie_value
+                    else:
+                        self.cookies.pop(key, None)
+        if self.record:
+            self.record(endpoint or path, status, elapsed)
+        return status, response_headers, data
+
+    def get(self, path, endpoint=None, headers=None):
+        return self.request("GET", path, endpoint, headers=headers)
+
+    def post_form(self, path, fields, endpoint=None):
+        body = urlencode(fields).encode()
+        return self.request("POST", path, endpoint, body, {"Content-Type": "application/x-www-form-urlencoded"})
+
+    def post_multipart(self, path, fields, files, endpoint=None):
+        body, content_type = encode_multipart(fields, files)
+        return self.request("POST", path, endpoint, body, {"Content-Type": content_type})
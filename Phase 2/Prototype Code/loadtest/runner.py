@@ -0,0 +1,116 @@
+import threading
+import time
+
+import numpy as np
+
+from loadtest.client import HttpSession
+from loadtest.scenarios import SCENARIOS
+
+
+"""
+
+#######################################################################################################################################################################333
+LOAD RUNNER
+
+Closed loop load: a fixed number of virtual users, each sending its next
+request as soon as the previous one is answered (plus an optional think time).
+Requests finishing during the warmup are dropped from the report.
+"""
+
+
+def summarize_load(records, duration):
+    """
+    Function reduces the recorded requests to per endpoint statistics
+    :param records: List of (endpoint, status, seconds)
+    :param duration: Measured seconds, used for the request rates
+    :return: Dictionary endpoint -> statistics, plus "all" over every request
+    """
+    endpoints = {}
+    for endpoint, status, seconds in records:
+        endpoints.setdefault(endpoint, []).append((status, seconds))
+    endpoints["all"] = [(status, seconds) for _, status, seconds in records]
+
+    report = {}
+    for endpoint, samples in sorted(endpoints.items()):
+        if not samples:
+            continue
+        statuses = np.array([status for status, _ in samples])
+        milliseconds = np.array([seconds for _, seconds in samples]) * 1000
+        p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+        codes, counts = np.unique(statuses, return_counts=True)
+        report[endpoint] = {
+            "requests": len(samples),
+            # status 0 is a dropped connection or a timeout
+            "errors": int(np.count_nonzero((statuses == 0) | (statuses >= 500))),
+            "status": {str(code): int(count) for code, count in zip(codes, counts)},
+            "throughput_per_s": round(len(samples) / duration, 2),
+            "p50_ms": round(float(p50), 2),
+            "p95_ms": round(float(p95), 2),
+            "p99_ms": round(float(p99), 2),
+            "max_ms": round(float(milliseconds.max()), 2),
+            "mean_ms": round(float(milliseconds.mean()), 2),
+        }
+    return report
+
+
+def run_load(base_url, fixtures, weights, users=8, duration=30, warmup=5, think_time=0, seed=0):
+    """
+    Function runs the virtual users against a server
+    :param base_url: e.g. "http://127.0.0.1:8080"
+    :param fixtures: Dictionary from scenarios.build_fixtures with "email" and "password" added
+    :param weights: Dictionary scenario name -> weight
+    :param users: Concurrent virtual users
+    :param duration: Measured seconds, after the warmup
+    :param warmup: Seconds of load before measuring
+    :param think_time: Seconds a user waits between two steps
+    :param seed: Seed of the users' random generators
+    :return: Dictionary with the settings and the per endpoint statistics under "endpoints"
+    """
+    unknown = [name for name in weights if name not in SCENARIOS]
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(unknown)}")
+    names = [name for name, weight in weights.items() if weight > 0]
+    probabilities = np.array([weights[name] for name in names], dtype=np.float64)
+    probabilities /= probabilities.sum()
+
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+    per_user = [[] for _ in range(users)]
+
+    def user(index):
+        rng = np.random.default_rng(seed + index)
+        records = per_user[index]
+
+        def record(endpoint, status, seconds):
+            if time.monotonic() >= measure_from:
+                records.append((endpoint, status, seconds))
+
+        session = HttpSession(base_url, record)
+        try:
+            SCENARIOS["login"](session, fixtures, rng)
+            while time.monotonic() < stop_at:
+                SCENARIOS[names[rng.choice(len(names), p=probabilities)]](session, fixtures, rng)
+                if think_time:
+                    time.sleep(think_time)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=user, args=(index,), name=f"load-user-{index}", daemon=True)
+               for index in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the last requests may end after stop_at, count the time actually measured
+    measured = max(time.monotonic(), stop_at) - measure_from
+    records = [record for records in per_user for record in records]
+    return {
+        "url": base_url,
+        "users": users,
+        "duration_s": round(measured, 2),
+        "warmup_s": warmup,
+        "weights": dict(weights),
+        "endpoints": summarize_load(records, measured),
+    }
@@ -0,0 +1,83 @@
+import numpy as np
+
+from benchmark.corpus import synthetic_image
+
+
+"""
+
+#######################################################################################################################################################################333
+SCENARIOS
+
+What one virtual user does in one step. Every scenario is called with the
+user's HttpSession, the shared fixtures and the user's random generator, and
+records its requests under a fixed endpoint name.
+"""
+
+# Centre of the generated images and of the gazetteer written for a spawned server
+CENTRE = (10.8958, 106.6953)
+
+# Weights used when none are given, roughly a dashboard user who uploads now and then
+DEFAULT_WEIGHTS = {"login": 1, "detect": 2, "db_data": 4, "visualize": 2, "get_location": 4}
+
+
+def build_fixtures(images=20, sizes=((1920, 1080), (4000, 3000)), densities=(0, 20, 100), input_size=640,
+                   locations=50, seed=0):
+    """
+    Function generates the uploads and coordinates the scenarios pick from
+    :param images: Number of distinct JPEG uploads, repeated uploads of the same file hit the result cache
+    :param sizes: Image sizes cycled through
+    :param densities: Objects per image cycled through
+    :param input_size: Model input size the objects are sized for
+    :param locations: Number of distinct coordinates asked to /get_location
+    :param seed: Seed of the random generator
+    :return: Dictionary with "images" (list of (filename, bytes)) and "locations" (list of (latitude, longitude))
+    """
+    rng = np.random.default_rng(seed)
+    uploads = []
+    for index in range(images):
+        width, height = sizes[index % len(sizes)]
+        latitude, longitude = CENTRE[0] + rng.uniform(-0.01, 0.01), CENTRE[1] + rng.uniform(-0.01, 0.01)
+        data = synthetic_image(width, height, densities[index % len(densities)], input_size, rng, latitude, longitude)
+        uploads.append((f"load_{index}.jpg", data))
+
+    points = [(round(CENTRE[0] + rng.uniform(-0.02, 0.02), 5), round(CENTRE[1] + rng.uniform(-0.02, 0.02), 5))
+              for _ in range(locations)]
+    return {"images": uploads, "locations": points}
+
+
+def login(session, fixtures, rng):
+    session.post_form("/login", {"email": fixtures["email"], "password": fixtures["password"]}, "POST /login")
+
+
+def detect(session, fixtures, rng):
+    filename, data = fixtures["images"][rng.integers(len(fixtures["images"]))]
+    session.post_multipart("/detect", {}, {"image_file": (filename, data, "image/jpeg")}, "POST /detect")
+
+
+def db_data(session, fixtures, rng):
+    session.get("/db_data", "GET /db_data")
+
+
+def visualize(session, fixtures, rng):
+    # the page, then its data the way the browser asks for it, revalidated with the last ETag
+    session.get("/visualize", "GET /visualize")
+    etag = session.etags.get("/visualize_data")
+    _, response_headers, _ = session.get("/visualize_data", "GET /visualize_data",
+                                         {"If-None-Match": etag} if etag else None)
+    for name, value in response_headers:
+        if name.lower() == "etag":
+            session.etags["/visualize_data"] = value
+
+
+def get_location(session, fixtures, rng):
+    latitude, longitude = fixtures["locations"][rng.integers(len(fixtures["locations"]))]
+    session.get(f"/get_location/{latitude}/{longitude}", "GET /get_location")
+
+
+SCENARIOS = {
+    "login": login,
+    "detect": detect,
+    "db_data": db_data,
+    "visualize": visualize,
+    "get_location": get_location,
+}
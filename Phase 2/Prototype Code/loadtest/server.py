@@ -0,0 +1,90 @@
+import csv
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+"""
+
+#######################################################################################################################################################################333
+SERVER UNDER TEST
+
+Starts app.py under waitress in its own process and folder, configured through
+the same REVA_ variables as a deployment. Reverse geocoding goes to a generated
+gazetteer instead of Nominatim.
+"""
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def free_port():
+    """
+    Function asks the OS for an unused local TCP port
+    :return: Port number
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_gazetteer(path, centre, step=0.005, radius=6):
+    """
+    Function writes a gazetteer CSV with a grid of made up places around a point
+    :param path: Where to write the CSV
+    :param centre: (latitude, longitude) of the grid centre
+    :param step: Grid spacing in degrees
+    :param radius: Grid points on each side of the centre
+    :return: path
+    """
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["latitude", "longitude", "address", "country", "postcode"])
+        for row in range(-radius, radius + 1):
+            for column in range(-radius, radius + 1):
+                writer.writerow([centre[0] + row * step, centre[1] + column * step,
+                                 f"Place {row},{column}", "Testland", f"{row + radius:02d}{column + radius:02d}"])
+    return path
+
+
+def spawn_server(workdir, model_path, gazetteer_path, threads=8, port=None, timeout=120):
+    """
+    Function starts the app under waitress and waits until it answers
+    :param workdir: Folder holding the database, caches and server.log
+    :param model_path: ONNX model served
+    :param gazetteer_path: Gazetteer CSV used for reverse geocoding
+    :param threads: waitress request threads
+    :param port: Port to listen on, None for a free one
+    :param timeout: Seconds to wait for the first answer
+    :return: Tuple (subprocess.Popen, base url)
+    """
+    port = port or free_port()
+    env = dict(os.environ,
+               REVA_HOST="127.0.0.1", REVA_PORT=str(port), REVA_THREADS=str(threads),
+               REVA_MODEL_PATH=model_path, REVA_MODEL_PATHS=model_path,
+               REVA_GEOCODERS="gazetteer", REVA_GAZETTEER=gazetteer_path,
+               REVA_GEOCODE_CACHE=os.path.join(workdir, "geocode_cache.db"),
+               REVA_RESULT_CACHE_PATH=os.path.join(workdir, "result_cache.db"),
+               PYTHONUNBUFFERED="1")
+    env.pop("REVA_DEBUG", None)
+
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    process = subprocess.Popen([sys.executable, APP_PATH], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}, see {workdir}/server.log")
+        try:
+            with urllib.request.urlopen(base_url + "/", timeout=5):
+                return process, base_url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError(f"Server did not answer within {timeout} s, see {workdir}/server.log")
@@ -0,0 +1,253 @@
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+
+"""
+
+#######################################################################################################################################################################333
+METRICS
+
+Counters, histograms and gauges kept in process and rendered in the Prometheus
+text format by /metrics. Code paths time themselves with stage("name"), which
+feeds the reva_stage_seconds histogram and, inside a request, the timings
+returned to the client in the Server-Timing header. Everything here is plain
+Python, no client library is needed.
+
+With several waitress processes every process has its own values, scrape
+each of them.
+"""
+
+METRICS_ENABLED = os.environ.get("REVA_METRICS", "1") == "1"
+
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DETECTION_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 300, 500, 1000)
+
+# Stage timings of the request running on the current thread, None outside a request
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic count per label values
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}_total{_labels(self.label_names, key)} {_number(value)}"
+
+
+class Histogram:
+    """
+    Distribution of observed values per label values, with cumulative buckets
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # one count per bucket, then the sum and the number of observations
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[index] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(entry) for key, entry in self._values.items()}
+        for key, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.label_names, key, [('le', _number(bound))])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {_number(entry[-2])}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {entry[-1]}"
+
+
+class Gauge:
+    """
+    Current value read from a function when the metrics are rendered
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, read):
+        """
+        :param read: Called without arguments, returns a number
+        """
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def samples(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            print("Error reading gauge", self.name + ":", e)
+            return
+        yield f"{self.name} {_number(value)}"
+
+
+class MetricsRegistry:
+    """
+    Named collection of metrics rendered together
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Function adds a metric, a metric of the same name is replaced
+        :return: The metric
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, read):
+        return self.register(Gauge(name, documentation, read))
+
+    def render(self):
+        """
+        Function renders every metric in the Prometheus text exposition format
+        :return: Text for a "text/plain; version=0.0.4" response
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry of the process
+registry = MetricsRegistry()
+
+REQUESTS = registry.counter("reva_http_requests", "HTTP requests handled", ("endpoint", "method", "status"))
+REQUEST_SECONDS = registry.histogram("reva_http_request_seconds", "Time to build the HTTP response", ("endpoint", "method"))
+STAGE_SECONDS = registry.histogram("reva_stage_seconds", "Time spent in each processing stage", ("stage",))
+DETECTIONS = registry.histogram("reva_detections_per_image", "Boxes returned per image", buckets=DETECTION_BUCKETS)
+CACHE_REQUESTS = registry.counter("reva_cache_requests", "Cache lookups by cache and result", ("cache", "result"))
+
+
+def cache_lookup(cache, hit):
+    """
+    Function counts one lookup of a cache
+    :param cache: Name of the cache, e.g. "result", "geocode" or "visualize"
+    :param hit: True when the value was found
+    """
+    if METRICS_ENABLED:
+        CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager timing one stage of the work, e.g. with stage("inference"): ...
+    :param name: Stage name, repeated stages of a request are added up
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def begin_request():
+    """
+    Function starts collecting the stage timings of the request on this thread
+    :return: Token for end_request
+    """
+    return _request_timings.set({})
+
+
+def end_request(token):
+    """
+    Function stops collecting stage timings for the request
+    :param token: Value returned by begin_request
+    :return: Dictionary stage -> seconds
+    """
+    timings = _request_timings.get() or {}
+    _request_timings.reset(token)
+    return timings
+
+
+def server_timing(timings, total=None):
+    """
+    Function formats stage timings as a Server-Timing header value
+    :param timings: Dictionary stage -> seconds
+    :param total: Seconds spent on the whole request, None to leave it out
+    :return: e.g. "decode;dur=12.1, inference;dur=40.3, total;dur=60.2"
+    """
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
@@ -0,0 +1,236 @@
+from db import get_connection
+
+
+"""
+
+#######################################################################################################################################################################333
+SCHEMA MIGRATIONS
+
+The database schema is built by an ordered list of migrations. The number of the
+last applied migration is kept in PRAGMA user_version, so starting the app only
+runs the migrations a database has not seen yet. Every migration runs in its own
+transaction, add new ones at the end of MIGRATIONS and never edit applied ones.
+"""
+
+
+def _columns(cursor, table):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+
+def _create_base_tables(cursor):
+    # User accounts
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name VARCHAR(100) NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            password VARCHAR(100) NOT NULL
+        )
+    """)
+
+    # One row per detected box, the user, filename and location columns are only set on legacy rows
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS object_detection_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            filename TEXT,
+            x1 INTEGER,
+            y1 INTEGER,
+            x2 INTEGER,
+            y2 INTEGER,
+            object_type TEXT,
+            probability REAL,
+            latitude REAL,
+            longitude REAL,
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    """)
+
+
+def _create_image_table(cursor):
+    # One row per uploaded image
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS image (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            filename TEXT,
+            latitude REAL,
+            longitude REAL,
+            created_at REAL,
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    """)
+
+    # Link the boxes to their image
+    if "image_id" not in _columns(cursor, "object_detection_data"):
+        cursor.execute("ALTER TABLE object_detection_data ADD COLUMN image_id INTEGER REFERENCES image (id)")
+
+    # Boxes written before the image table existed get an image built from their own columns
+    if cursor.execute("SELECT 1 FROM object_detection_data WHERE image_id IS NULL LIMIT 1").fetchone():
+        cursor.execute("""
+            INSERT INTO image (user_id, filename, latitude, longitude)
+            SELECT DISTINCT user_id, filename, latitude, longitude
+            FROM object_detection_data WHERE image_id IS NULL
+        """)
+        cursor.execute("""
+            UPDATE object_detection_data SET image_id = (
+                SELECT MAX(image.id) FROM image
+                WHERE image.user_id IS object_detection_data.user_id
+                  AND image.filename IS object_detection_data.filename
+                  AND image.latitude IS object_detection_data.latitude
+                  AND image.longitude IS object_detection_data.longitude
+            ) WHERE image_id IS NULL
+        """)
+
+
+def _add_image_summary(cursor):
+    # Boxes are only ever looked up through their image
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_detection_image ON object_detection_data (image_id)")
+
+    # Capture time from the image metadata and the number of boxes, so summaries never touch the box table
+    columns = _columns(cursor, "image")
+    if "captured_at" not in columns:
+        cursor.execute("ALTER TABLE image ADD COLUMN captured_at REAL")
+    if "detection_count" not in columns:
+        cursor.execute("ALTER TABLE image ADD COLUMN detection_count INTEGER NOT NULL DEFAULT 0")
+
+    cursor.execute("""
+        UPDATE image SET detection_count = counts.total
+        FROM (SELECT image_id, COUNT(*) AS total FROM object_detection_data GROUP BY image_id) AS counts
+        WHERE counts.image_id = image.id
+    """)
+
+    # Covering indexes for the dashboard reads, per filename and per location of a user
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_image_user_filename
+        ON image (user_id, filename, latitude, longitude, detection_count)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_image_user_location
+        ON image (user_id, latitude, longitude, detection_count)
+    """)
+
+
+def _create_job_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS detection_job (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            filename TEXT,
+            status TEXT NOT NULL,
+            latitude REAL,
+            longitude REAL,
+            result TEXT,
+            error TEXT,
+            created_at REAL,
+            finished_at REAL,
+            server_pid INTEGER,
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    """)
+
+
+def _create_summary_tables(cursor):
+    # Running totals kept up to date by every image insert, see repository._update_summaries.
+    # Rows are only kept for known keys, legacy images without a location or a time are left out of those tables.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_summary (
+            user_id INTEGER PRIMARY KEY,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            detection_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS location_summary (
+            user_id INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            detection_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, latitude, longitude)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_summary (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            detection_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    """)
+
+    # Totals of the images stored so far
+    cursor.execute("""
+        INSERT INTO user_summary (user_id, image_count, detection_count)
+        SELECT user_id, COUNT(*), SUM(detection_count) FROM image
+        WHERE user_id IS NOT NULL GROUP BY user_id
+    """)
+    cursor.execute("""
+        INSERT INTO location_summary (user_id, latitude, longitude, image_count, detection_count)
+        SELECT user_id, latitude, longitude, COUNT(*), SUM(detection_count) FROM image
+        WHERE user_id IS NOT NULL AND latitude IS NOT NULL AND longitude IS NOT NULL
+        GROUP BY user_id, latitude, longitude
+    """)
+    cursor.execute("""
+        INSERT INTO daily_summary (user_id, day, image_count, detection_count)
+        SELECT user_id, date(COALESCE(captured_at, created_at), 'unixepoch') AS day, COUNT(*), SUM(detection_count) FROM image
+        WHERE user_id IS NOT NULL AND COALESCE(captured_at, created_at) IS NOT NULL
+        GROUP BY user_id, day
+    """)
+
+
+def _add_image_content_hash(cursor):
+    # SHA-256 of the uploaded file, an image a user already uploaded is not stored again
+    if "content_hash" not in _columns(cursor, "image"):
+        cursor.execute("ALTER TABLE image ADD COLUMN content_hash TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_user_content_hash ON image (user_id, content_hash)")
+
+
+# Ordered list of (version, description, function), every function is given a cursor inside the transaction.
+# The first steps use IF NOT EXISTS and column checks since databases created before versioning already have them.
+MIGRATIONS = [
+    (1, "user and object_detection_data tables", _create_base_tables),
+    (2, "image table linked from object_detection_data", _create_image_table),
+    (3, "image capture time, detection count and covering indexes", _add_image_summary),
+    (4, "detection_job table", _create_job_table),
+    (5, "per user, location and day summary tables", _create_summary_tables),
+    (6, "image content hash", _add_image_content_hash),
+]
+
+
+def schema_version(db_path):
+    """
+    Function returns the number of the last migration applied to a database
+    :param db_path: Path of the SQLite database
+    :return: Schema version, 0 for a database never migrated
+    """
+    return get_connection(db_path).execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db_path, migrations=MIGRATIONS):
+    """
+    Function applies the migrations a database is missing, in order
+    :param db_path: Path of the SQLite database
+    :param migrations: Ordered list of (version, description, function)
+    :return: List of the versions applied by this call
+    """
+    connection = get_connection(db_path)
+    applied = []
+    for version, description, function in migrations:
+        if version <= schema_version(db_path):
+            continue
+
+        # take the write lock first so two processes starting together never run the same step
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if version > schema_version(db_path):
+                function(connection.cursor())
+                connection.execute(f"PRAGMA user_version = {int(version)}")
+                applied.append(version)
+                print(f"Applying migration {version}: {description}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+    return applied
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+"""
+
+#######################################################################################################################################################################333
+MODEL REGISTRY
+
+Keeps one ONNX InferenceSession per model for the lifetime of the worker process
+instead of building a new one on every /detect call. InferenceSession.run is
+thread safe, so the same session is shared across all waitress threads.
+"""
+
+# Default model used by the detection routes
+MODEL_PATH = os.environ.get("REVA_MODEL_PATH", "Phase2_TeamAtlanticModel.onnx")
+
+# Quantized variant served instead of the FP32 model, see quantize.py
+MODEL_VARIANT = os.environ.get("REVA_MODEL_VARIANT", "")
+
+# Input size assumed when neither the graph nor its metadata fixes it
+DEFAULT_INPUT_SIZE = 2176
+
+# Session tuning, 0 lets onnxruntime pick the thread counts itself
+INTRA_OP_THREADS = int(os.environ.get("REVA_INTRA_OP_THREADS", "0"))
+INTER_OP_THREADS = int(os.environ.get("REVA_INTER_OP_THREADS", "0"))
+GRAPH_OPT_LEVEL = os.environ.get("REVA_GRAPH_OPT_LEVEL", "all")
+
+# Folder used to store the optimized graph so later workers can skip optimization
+OPTIMIZED_MODEL_DIR = os.environ.get("REVA_OPTIMIZED_MODEL_DIR", "")
+
+# Number of dummy inferences run when a model is loaded
+WARMUP_RUNS = int(os.environ.get("REVA_WARMUP_RUNS", "1"))
+
+# Names in onnxruntime.GraphOptimizationLevel, onnxruntime itself is only imported when a model is loaded
+GRAPH_OPT_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def build_session_options(intra_op_threads=INTRA_OP_THREADS, inter_op_threads=INTER_OP_THREADS,
+                          graph_opt_level=GRAPH_OPT_LEVEL, optimized_model_path=None):
+    """
+    Function builds the onnxruntime SessionOptions used for every model
+    :param intra_op_threads: Threads used inside a single operator, 0 for the onnxruntime default
+    :param inter_op_threads: Threads used to run independent operators, 0 for the onnxruntime default
+    :param graph_opt_level: One of "disable", "basic", "extended" or "all"
+    :param optimized_model_path: Where to write the optimized graph, None to skip
+    :return: onnxruntime.SessionOptions object
+    """
+    if graph_opt_level not in GRAPH_OPT_LEVELS:
+        raise ValueError(f"Unknown graph optimization level: {graph_opt_level}")
+
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, GRAPH_OPT_LEVELS[graph_opt_level])
+    if optimized_model_path:
+        options.optimized_model_filepath = optimized_model_path
+    return options
+
+
+def saved_opt_level(graph_opt_level=GRAPH_OPT_LEVEL):
+    """
+    Function returns the optimization level a graph is serialized at.
+    "all" adds layout transforms for the CPU it runs on, a saved graph stops at "extended"
+    and the rest is applied when it is loaded
+    """
+    return "extended" if graph_opt_level == "all" else graph_opt_level
+
+
+def optimized_model_path_for(model_path, cache_dir=OPTIMIZED_MODEL_DIR, graph_opt_level=GRAPH_OPT_LEVEL):
+    """
+    Function returns the path of the serialized optimized graph for a model
+    :param model_path: Path of the original ONNX model
+    :param cache_dir: Folder holding the optimized graphs, empty to disable the cache
+    :param graph_opt_level: Optimization level of the sessions
+    :return: Path of the optimized model or None when the cache is disabled.
+             The name changes with the model file, the onnxruntime version and the level,
+             so a replaced model is never served from an old graph
+    """
+    if not cache_dir:
+        return None
+    import onnxruntime as ort
+
+    stat = os.stat(model_path)
+    version = f"{stat.st_size}:{stat.st_mtime_ns}:{ort.__version__}:{saved_opt_level(graph_opt_level)}"
+    name, _ = os.path.splitext(os.path.basename(model_path))
+    digest = hashlib.sha256(version.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{name}.{digest}.optimized.onnx")
+
+
+def model_input_size(session, default=DEFAULT_INPUT_SIZE):
+    """
+    Function reads the square input size a model was exported with, first from
+    the graph input shape and then from the "imgsz" metadata written by ultralytics
+    :param session: onnxruntime.InferenceSession
+    :param default: Size returned when the model does not say
+    :return: Side of the square model input in pixels
+    """
+    shape = session.get_inputs()[0].shape
+    if len(shape) == 4 and isinstance(shape[2], int) and shape[2] == shape[3]:
+        return shape[2]
+
+    imgsz = session.get_modelmeta().custom_metadata_map.get("imgsz")
+    if imgsz:
+        sizes = [int(size) for size in imgsz.strip("[]() ").split(",") if size.strip()]
+        if sizes and all(size == sizes[0] for size in sizes):
+            return sizes[0]
+    return default
+
+
+def variant_path(model_path, variant=None):
+    """
+    Function returns where a named variant of a model is stored, next to the
+    original as "<model>.<variant>.onnx", e.g. "int8-dynamic", "int8-static" or "fp16"
+    :param model_path: Path of the original FP32 ONNX model
+    :param variant: Name of the variant, None or "fp32" for the original model
+    :return: Path of the variant
+    """
+    if not variant or variant == "fp32":
+        return model_path
+    name, ext = os.path.splitext(model_path)
+    return f"{name}.{variant}{ext or '.onnx'}"
+
+
+class ModelRegistry:
+    """
+    Process wide cache of onnxruntime sessions keyed by model path.
+    Sessions are created lazily the first time they are requested and
+    warmed up once so the first real request does not pay for it.
+    """
+
+    def __init__(self, warmup_runs=WARMUP_RUNS, cache_dir=OPTIMIZED_MODEL_DIR):
+        self.warmup_runs = warmup_runs
+        self.cache_dir = cache_dir
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_path=MODEL_PATH):
+        """
+        Function returns the shared session for a model, loading it on first use
+        :param model_path: Path of the ONNX model
+        :return: onnxruntime.InferenceSession
+        """
+        session = self._sessions.get(model_path)
+        if session is not None:
+            return session
+
+        with self._lock:
+            # another thread may have loaded it while we were waiting
+            session = self._sessions.get(model_path)
+            if session is None:
+                session = self._load(model_path)
+                self._sessions[model_path] = session
+        return session
+
+    def _load(self, model_path):
+        import onnxruntime as ort
+
+        optimized_path = optimized_model_path_for(model_path, self.cache_dir)
+        if optimized_path:
+            if not os.path.exists(optimized_path):
+                self._save_optimized(model_path, optimized_path)
+            # the saved graph skips the expensive passes, the host specific ones still run here
+            session = ort.InferenceSession(optimized_path, build_session_options())
+        else:
+            session = ort.InferenceSession(model_path, build_session_options())
+
+        self.warm_up(session)
+        return session
+
+    def _save_optimized(self, model_path, optimized_path):
+        import onnxruntime as ort
+
+        os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
+        # written under a name of its own and moved into place, a worker starting at the same time
+        # either finds no graph and builds one too, or finds a complete one
+        temp_path = f"{optimized_path[:-len('.onnx')]}.{os.getpid()}.{threading.get_ident()}.tmp.onnx"
+        try:
+            options = build_session_options(graph_opt_level=saved_opt_level(), optimized_model_path=temp_path)
+            ort.InferenceSession(model_path, options)
+            os.replace(temp_path, optimized_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def warm_up(self, session, runs=None):
+        """
+        Function runs dummy inferences so lazy allocations happen before real traffic
+        :param session: onnxruntime.InferenceSession to warm up
+        :param runs: Number of runs, defaults to the registry setting
+        """
+        runs = self.warmup_runs if runs is None else runs
+        if runs <= 0:
+            return
+        model_input = session.get_inputs()[0]
+        size = model_input_size(session)
+        # dynamic dimensions come back as strings or None, use a single image of the model size
+        shape = [dim if isinstance(dim, int) else fallback
+                 for dim, fallback in zip(model_input.shape, [1, 3, size, size])]
+        dummy = np.zeros(shape, dtype=np.float32)
+        for _ in range(runs):
+            session.run(None, {model_input.name: dummy})
+
+    def input_size(self, model_path=MODEL_PATH):
+        """
+        Function returns the square input size of a model, loading it if needed
+        :param model_path: Path of the ONNX model
+        :return: Side of the square model input in pixels
+        """
+        return model_input_size(self.get(model_path))
+
+    def preload(self, model_path=MODEL_PATH):
+        """
+        Function loads a model at startup and reports instead of raising on failure
+        :param model_path: Path of the ONNX model
+        :return: True if the model is ready
+        """
+        try:
+            self.get(model_path)
+            return True
+        except Exception as e:
+            print("Error preloading model:", e)
+            return False
+
+
+# Shared registry used by the whole worker process
+registry = ModelRegistry()
@@ -0,0 +1,83 @@
+import os
+import threading
+
+from model_registry import registry, variant_path, MODEL_PATH, MODEL_VARIANT
+from metrics import registry as metrics_registry
+
+
+"""
+
+#######################################################################################################################################################################333
+RESOLUTION SELECTION
+
+Several exports of the detector at different input sizes can be served side by
+side. Each request picks one through its "quality" parameter, and "auto" steps
+down to a smaller, faster model while the worker is busy instead of queueing.
+"""
+
+# Comma separated ONNX models, their input sizes are read from the models themselves.
+# REVA_MODEL_VARIANT swaps every one of them for its quantized variant.
+MODEL_PATHS = [variant_path(path.strip(), MODEL_VARIANT)
+               for path in os.environ.get("REVA_MODEL_PATHS", MODEL_PATH).split(",") if path.strip()]
+
+# In flight detections per step down to the next smaller model in "auto" mode
+DEGRADE_STEP = int(os.environ.get("REVA_DEGRADE_STEP", "2"))
+
+QUALITY_LEVELS = ("auto", "low", "medium", "high")
+
+
+class LoadTracker:
+    """
+    Thread safe counter of the detections currently running in this worker
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.value += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._lock:
+            self.value -= 1
+
+
+# Shared load counter for the whole worker process
+load = LoadTracker()
+metrics_registry.gauge("reva_detections_in_flight", "Detections running in this process", lambda: load.value)
+
+
+def models_by_size(model_paths=None):
+    """
+    Function sorts the served models from the smallest to the largest input size
+    :param model_paths: List of ONNX model paths, defaults to REVA_MODEL_PATHS
+    :return: List of model paths
+    """
+    return sorted(model_paths or MODEL_PATHS, key=registry.input_size)
+
+
+def select_model(quality="auto", in_flight=0, model_paths=None):
+    """
+    Function picks the model used for a request
+    :param quality: One of "auto", "low", "medium" or "high"
+    :param in_flight: Number of detections already running, used by "auto"
+    :param model_paths: List of ONNX model paths, defaults to REVA_MODEL_PATHS
+    :return: Path of the selected ONNX model
+    """
+    if quality not in QUALITY_LEVELS:
+        raise ValueError(f"Unknown quality: {quality}")
+
+    models = models_by_size(model_paths)
+    if quality == "low":
+        return models[0]
+    if quality == "medium":
+        return models[len(models) // 2]
+    if quality == "high" or DEGRADE_STEP <= 0:
+        return models[-1]
+
+    # "auto" serves the largest model until the worker gets busy
+    steps = in_flight // DEGRADE_STEP
+    return models[max(0, len(models) - 1 - steps)]
@@ -0,0 +1,148 @@
+import numpy as np
+
+from preprocess import letterbox_geometry
+
+
+"""
+
+#######################################################################################################################################################################333
+YOLOv8 OUTPUT DECODING AND NMS
+
+Array based replacements for the per row loop and the pairwise iou() calls
+that process_output used to do. Everything works on contiguous float32 arrays.
+"""
+
+
+def decode_output(output, conf_threshold=0.2, max_candidates=None):
+    """
+    Function converts the RAW YOLOv8 output to boxes, scores and class ids,
+    dropping every candidate under the confidence threshold with a single mask
+    before any per candidate work is done
+    :param output: Raw output of YOLOv8 network which is an array of shape (1,4+classes,candidates)
+    :param conf_threshold: Minimum class probability for a candidate to be kept
+    :param max_candidates: Keep only this many of the best candidates, None for no limit
+    :return: Tuple of boxes (n,4) in [x1,y1,x2,y2] model pixels, scores (n,) and class ids (n,)
+    """
+    predictions = output[0]
+    class_scores = predictions[4:]
+
+    if class_scores.shape[0] == 1:
+        # single class model, no argmax needed
+        scores = class_scores[0]
+        mask = np.flatnonzero(scores >= conf_threshold)
+        scores = scores[mask]
+        class_ids = np.zeros(mask.shape[0], dtype=np.int64)
+    else:
+        # best score of every candidate first, the argmax only runs on the ones above the threshold
+        mask = np.flatnonzero(class_scores.max(axis=0) >= conf_threshold)
+        class_ids = class_scores[:, mask].argmax(axis=0)
+        scores = class_scores[class_ids, mask]
+
+    if max_candidates is not None and mask.shape[0] > max_candidates:
+        best = np.argpartition(-scores, max_candidates - 1)[:max_candidates]
+        mask, scores, class_ids = mask[best], scores[best], class_ids[best]
+
+    xc, yc, w, h = predictions[:4, mask].astype(np.float32)
+
+    boxes = np.empty((xc.shape[0], 4), dtype=np.float32)
+    boxes[:, 0] = xc - w / 2
+    boxes[:, 1] = yc - h / 2
+    boxes[:, 2] = xc + w / 2
+    boxes[:, 3] = yc + h / 2
+
+    return boxes, scores.astype(np.float32), class_ids
+
+
+def scale_boxes(boxes, img_width, img_height, input_size):
+    """
+    Function maps boxes from the letterboxed model input back to the original image
+    :param boxes: Array of boxes of shape (n,4) in format [x1,y1,x2,y2] in model pixels
+    :param img_width: The width of original image
+    :param img_height: The height of original image
+    :param input_size: Side of the square model input
+    :return: Array of boxes of shape (n,4) in original image pixels, clipped to the image
+    """
+    scale, _, _, pad_x, pad_y = letterbox_geometry(img_width, img_height, input_size)
+    boxes = (boxes - np.array([pad_x, pad_y, pad_x, pad_y], dtype=np.float32)) / scale
+    np.clip(boxes[:, 0::2], 0, img_width, out=boxes[:, 0::2])
+    np.clip(boxes[:, 1::2], 0, img_height, out=boxes[:, 1::2])
+    return boxes
+
+
+def box_iou(box, boxes):
+    """
+    Function calculates "Intersection-over-union" of one box against many boxes
+    :param box: Box in format [x1,y1,x2,y2]
+    :param boxes: Array of boxes of shape (n,4) in format [x1,y1,x2,y2]
+    :return: Array of shape (n,) with the intersection over union ratios
+    """
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+    box_area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = box_area + areas - inter
+    return inter / np.maximum(union, np.finfo(np.float32).eps)
+
+
+def nms(boxes, scores, iou_threshold=0.3, top_k=None):
+    """
+    Function runs greedy non maximum suppression, comparing the best remaining
+    box against all the others in one array operation per kept box
+    :param boxes: Array of boxes of shape (n,4) in format [x1,y1,x2,y2]
+    :param scores: Array of shape (n,) with the box probabilities
+    :param iou_threshold: Boxes overlapping a kept box by this much or more are dropped
+    :param top_k: Maximum number of boxes to keep, None for no limit
+    :return: Indices of the kept boxes sorted by descending score
+    """
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while order.size > 0:
+        best = order[0]
+        keep.append(best)
+        if top_k is not None and len(keep) >= top_k:
+            break
+        rest = order[1:]
+        order = rest[box_iou(boxes[best], boxes[rest]) < iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def batched_nms(boxes, scores, class_ids, iou_threshold=0.3, top_k=None, agnostic=False):
+    """
+    Function runs non maximum suppression per class, or across all classes when agnostic.
+    Boxes of different classes are shifted apart so they can never overlap,
+    which lets a single nms() call handle every class at once
+    :param boxes: Array of boxes of shape (n,4) in format [x1,y1,x2,y2]
+    :param scores: Array of shape (n,) with the box probabilities
+    :param class_ids: Array of shape (n,) with the box class ids
+    :param iou_threshold: Boxes overlapping a kept box by this much or more are dropped
+    :param top_k: Maximum number of boxes to keep, None for no limit
+    :param agnostic: Suppress overlapping boxes even when their classes differ
+    :return: Indices of the kept boxes sorted by descending score
+    """
+    if boxes.shape[0] == 0:
+        return np.empty(0, dtype=np.int64)
+    if agnostic:
+        return nms(boxes, scores, iou_threshold, top_k)
+
+    offsets = class_ids.astype(np.float32) * (boxes.max() - boxes.min() + 1)
+    shifted = np.ascontiguousarray(boxes + offsets[:, None])
+    return nms(shifted, scores, iou_threshold, top_k)
+
+
+def to_box_list(boxes, scores, class_ids, labels):
+    """
+    Function converts detection arrays to the JSON friendly list returned by the API
+    :param boxes: Array of boxes of shape (n,4) in format [x1,y1,x2,y2]
+    :param scores: Array of shape (n,) with the box probabilities
+    :param class_ids: Array of shape (n,) with the box class ids
+    :param labels: List of class labels indexed by class id
+    :return: Array of detected objects in a format [[x1,y1,x2,y2,object_type,probability],..]
+    """
+    result = []
+    for box, class_id, prob in zip(boxes.tolist(), class_ids.tolist(), scores.tolist()):
+        result.append(box + [labels[class_id], prob])
+    return result
@@ -0,0 +1,224 @@
+import io
+import mmap
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from metrics import stage
+
+
+"""
+
+#######################################################################################################################################################################333
+IMAGE PREPROCESSING
+
+Letterboxes the uploaded image and writes it straight into a float32 NCHW
+tensor that is allocated once per worker thread and reused for every request,
+instead of building several full size float64 copies per upload.
+
+An upload is read once with read_upload, the decoder and the metadata reader
+both work on views of that one buffer. JPEGs much larger than the model input
+are decoded at a reduced scale by libjpeg (PIL draft mode) before resizing.
+"""
+
+# Side of the square input expected by the exported model
+INPUT_SIZE = 2176
+
+# Grey used by YOLOv8 for the letterbox border, already scaled to [0, 1]
+PAD_VALUE = 114 / 255.0
+
+# Let libjpeg decode at 1/2, 1/4 or 1/8 scale when the model input is that much smaller
+JPEG_DRAFT = os.environ.get("REVA_JPEG_DRAFT", "1") == "1"
+
+# Uploads of at least this size are memory mapped from their file, smaller ones are copied once
+MMAP_MIN_BYTES = 1024 * 1024
+
+_thread_buffers = threading.local()
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read only, seekable file object over a bytes like object, reads copy only the requested range
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        chunk = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+
+def read_upload(stream):
+    """
+    Function reads an uploaded file once into a buffer shared by every later stage.
+    Large uploads backed by a file (Werkzeug spools them to a temporary file) are
+    memory mapped instead of read, small ones are read into bytes
+    :param stream: Uploaded file input stream, e.g. request.files["image_file"].stream
+    :return: bytes or mmap.mmap holding the whole file
+    """
+    if isinstance(stream, io.BytesIO):
+        return stream.getvalue()
+
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    if size >= MMAP_MIN_BYTES:
+        try:
+            # a SpooledTemporaryFile still in memory rolls over to its file here
+            fileno = stream.fileno()
+            stream.flush()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            fileno = None
+        if fileno is not None and os.fstat(fileno).st_size >= size:
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    return stream.read()
+
+
+def open_image_source(source):
+    """
+    Function returns a file object for an image given as a file object or as a buffer
+    :param source: File object, bytes, memoryview or mmap
+    :return: File object positioned at the start of the image
+    """
+    if hasattr(source, "read") and not isinstance(source, mmap.mmap):
+        return source
+    return BufferReader(source)
+
+
+def letterbox_geometry(img_width, img_height, input_size=INPUT_SIZE):
+    """
+    Function calculates how an image is placed inside the square model input
+    while keeping its aspect ratio
+    :param img_width: The width of original image
+    :param img_height: The height of original image
+    :param input_size: Side of the square model input
+    :return: Tuple (scale, new_width, new_height, pad_x, pad_y)
+    """
+    scale = min(input_size / img_width, input_size / img_height)
+    new_width = max(1, min(input_size, round(img_width * scale)))
+    new_height = max(1, min(input_size, round(img_height * scale)))
+    pad_x = (input_size - new_width) // 2
+    pad_y = (input_size - new_height) // 2
+    return scale, new_width, new_height, pad_x, pad_y
+
+
+def get_input_buffer(input_size=INPUT_SIZE, batch_size=1):
+    """
+    Function returns the preallocated input tensor of the calling thread,
+    allocating it the first time a given shape is requested
+    :param input_size: Side of the square model input
+    :param batch_size: Number of images the tensor holds
+    :return: Numpy float32 array in a shape (batch_size,3,input_size,input_size)
+    """
+    buffers = getattr(_thread_buffers, "tensors", None)
+    if buffers is None:
+        buffers = _thread_buffers.tensors = {}
+
+    key = (batch_size, input_size)
+    tensor = buffers.get(key)
+    if tensor is None:
+        tensor = np.empty((batch_size, 3, input_size, input_size), dtype=np.float32)
+        buffers[key] = tensor
+    return tensor
+
+
+def write_letterboxed(img, tensor, input_size=INPUT_SIZE, source_size=None):
+    """
+    Function resizes a PIL image with its aspect ratio kept and writes it,
+    normalized to [0, 1], into one (3,input_size,input_size) slot of a tensor
+    :param img: PIL image in RGB mode
+    :param tensor: Numpy float32 array in a shape (3,input_size,input_size) to fill
+    :param input_size: Side of the square model input
+    :param source_size: (width, height) of the original image when img was decoded at a reduced scale,
+                        the placement follows the original so boxes map back exactly
+    """
+    img_width, img_height = source_size or img.size
+    _, new_width, new_height, pad_x, pad_y = letterbox_geometry(img_width, img_height, input_size)
+    if (new_width, new_height) != img.size:
+        img = img.resize((new_width, new_height), Image.BILINEAR)
+
+    # only the border is painted, the image area is overwritten below
+    tensor[:, :pad_y, :] = PAD_VALUE
+    tensor[:, pad_y + new_height:, :] = PAD_VALUE
+    tensor[:, pad_y:pad_y + new_height, :pad_x] = PAD_VALUE
+    tensor[:, pad_y:pad_y + new_height, pad_x + new_width:] = PAD_VALUE
+
+    # uint8 HWC view of the pixels, each channel is scaled directly into the tensor
+    pixels = np.asarray(img)
+    for channel in range(3):
+        np.multiply(pixels[:, :, channel], 1 / 255.0,
+                    out=tensor[channel, pad_y:pad_y + new_height, pad_x:pad_x + new_width],
+                    casting="unsafe")
+
+
+def load_rgb_image(buf):
+    """
+    Function decodes an uploaded image into a PIL image in RGB mode
+    :param buf: Uploaded file input stream or a buffer from read_upload
+    :return: PIL image in RGB mode
+    """
+    img = Image.open(open_image_source(buf))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
+
+
+def load_scaled_image(buf, input_size=INPUT_SIZE):
+    """
+    Function decodes an image for a model input of a given size, JPEGs at least twice as large
+    as the letterboxed size are decoded at 1/2, 1/4 or 1/8 scale, never below that size
+    :param buf: Uploaded file input stream or a buffer from read_upload
+    :param input_size: Side of the square model input
+    :return: Tuple (PIL image in RGB mode, width of the original image, height of the original image)
+    """
+    img = Image.open(open_image_source(buf))
+    img_width, img_height = img.size
+    if JPEG_DRAFT and img.format == "JPEG":
+        _, new_width, new_height, _, _ = letterbox_geometry(img_width, img_height, input_size)
+        img.draft("RGB", (new_width, new_height))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img, img_width, img_height
+
+
+def prepare_image(buf, input_size=INPUT_SIZE):
+    """
+    Function decodes an image and letterboxes it into the thread's reusable input tensor.
+    The returned tensor is overwritten by the next call on the same thread,
+    so it must be consumed by the model before preparing another image
+    :param buf: Uploaded file input stream or a buffer from read_upload
+    :param input_size: Side of the square model input
+    :return: Tuple (tensor of shape (1,3,input_size,input_size), img_width, img_height)
+    """
+    with stage("decode"):
+        img, img_width, img_height = load_scaled_image(buf, input_size)
+        # PIL decodes lazily, do it here so the time is not counted as preprocessing
+        img.load()
+    with stage("preprocess"):
+        tensor = get_input_buffer(input_size)
+        write_letterboxed(img, tensor[0], input_size, (img_width, img_height))
+    return tensor, img_width, img_height
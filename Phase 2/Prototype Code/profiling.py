@@ -0,0 +1,244 @@
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+
+"""
+
+#######################################################################################################################################################################333
+REQUEST PROFILING
+
+Opt-in (REVA_PROFILE=1) sampling profiler for the request threads. While a
+request runs its thread's stack is sampled every REVA_PROFILE_INTERVAL_MS; when
+the request ends the samples are kept if it took longer than
+REVA_PROFILE_SLOW_MS or if it is one of the REVA_PROFILE_DETECT_RATE fraction
+of /detect calls picked at random, and dropped otherwise. Whether a request is
+slow is only known at its end, so every request is sampled; reading a stack
+every few milliseconds costs far less than tracing every call with cProfile,
+and unlike cProfile any number of threads can be sampled at once.
+
+Kept profiles are JSON files in REVA_PROFILE_DIR, only the REVA_PROFILE_KEEP
+newest are kept. The stacks are in the collapsed format of flamegraph.pl and
+speedscope. Only the request thread is sampled: work handed to the batcher or
+the job pool shows up as the request waiting for it, and the body of a streamed
+response (/ingest) runs after the profile is closed.
+"""
+
+PROFILE_ENABLED = os.environ.get("REVA_PROFILE", "0") == "1"
+
+# Requests taking at least this long are kept
+PROFILE_SLOW_MS = float(os.environ.get("REVA_PROFILE_SLOW_MS", "1000"))
+
+# Fraction of /detect calls kept whatever their duration
+PROFILE_DETECT_RATE = float(os.environ.get("REVA_PROFILE_DETECT_RATE", "0.01"))
+
+PROFILE_INTERVAL_MS = float(os.environ.get("REVA_PROFILE_INTERVAL_MS", "5"))
+
+PROFILE_DIR = os.environ.get("REVA_PROFILE_DIR", "profiles")
+
+# Number of profiles kept on disk, the oldest are deleted first
+PROFILE_KEEP = int(os.environ.get("REVA_PROFILE_KEEP", "50"))
+
+# Frames kept per sample, counted from the innermost one
+MAX_STACK_DEPTH = 128
+
+# Names of the profile files, the timestamp first so they sort by age
+_PROFILE_ID = re.compile(r"^\d{8}T\d{9}-[A-Za-z0-9_]+-[0-9a-f]{8}$")
+
+
+def _collapse(frame):
+    """
+    Function turns a frame and its callers into one collapsed stack
+    :return: e.g. "main (app.py:680);detect (app.py:455);infer (batching.py:80)", outermost frame first
+    """
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class StackSampler:
+    """
+    Background thread counting the stacks of the threads registered with start()
+    """
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id):
+        """
+        Function starts counting the stacks of a thread
+        :param thread_id: threading.get_ident() of the thread
+        """
+        with self._lock:
+            self._stacks[thread_id] = {}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="reva-profiler", daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        """
+        Function stops counting the stacks of a thread
+        :return: Dictionary collapsed stack -> number of samples
+        """
+        with self._lock:
+            return self._stacks.pop(thread_id, None) or {}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._stacks:
+                    continue
+                thread_ids = list(self._stacks)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = _collapse(frame)
+                with self._lock:
+                    counts = self._stacks.get(thread_id)
+                    if counts is not None:
+                        counts[stack] = counts.get(stack, 0) + 1
+            # drop the frame references before sleeping
+            frames = frame = None
+
+
+class ProfileStore:
+    """
+    Bounded folder of profiles, writing one past the limit deletes the oldest
+    """
+
+    def __init__(self, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = max(keep, 1)
+        self._lock = threading.Lock()
+
+    def _path(self, profile_id):
+        return os.path.join(self.directory, profile_id + ".json")
+
+    def _ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith(".json") and _PROFILE_ID.match(name[:-5]))
+
+    def save(self, profile):
+        """
+        Function writes a profile and deletes the oldest ones above the limit
+        :param profile: Dictionary with at least "endpoint", see end_profile
+        :return: Id of the profile
+        """
+        now = time.time()
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f"{int(now * 1000) % 1000:03d}"
+        endpoint = re.sub(r"[^A-Za-z0-9_]", "_", profile["endpoint"])
+        profile_id = f"{stamp}-{endpoint}-{uuid.uuid4().hex[:8]}"
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self._path(profile_id) + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(dict(profile, id=profile_id), file)
+            os.replace(temp_path, self._path(profile_id))
+
+            for old_id in self._ids()[:-self.keep]:
+                try:
+                    os.remove(self._path(old_id))
+                except OSError as e:
+                    print("Error deleting old profile:", e)
+        return profile_id
+
+    def list(self):
+        """
+        Function lists the stored profiles, newest first
+        :return: List of dictionaries with the profile fields except the stacks
+        """
+        profiles = []
+        for profile_id in reversed(self._ids()):
+            profile = self.load(profile_id)
+            if profile is not None:
+                profile.pop("stacks", None)
+                profiles.append(profile)
+        return profiles
+
+    def load(self, profile_id):
+        """
+        Function reads one profile
+        :return: The profile dictionary or None if there is no such profile
+        """
+        if not _PROFILE_ID.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id), encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+
+def collapsed_stacks(profile):
+    """
+    Function formats the stacks of a profile for flamegraph.pl or speedscope
+    :return: Text with one "stack count" line per distinct stack
+    """
+    stacks = sorted(profile["stacks"].items(), key=lambda item: item[1], reverse=True)
+    return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+
+sampler = StackSampler()
+profile_store = ProfileStore()
+
+
+def begin_profile(endpoint):
+    """
+    Function starts sampling the request running on this thread
+    :param endpoint: Flask endpoint of the request, "detect" calls may be picked to be kept
+    :return: Handle for end_profile
+    """
+    thread_id = threading.get_ident()
+    picked = endpoint == "detect" and random.random() < PROFILE_DETECT_RATE
+    sampler.start(thread_id)
+    return {"thread_id": thread_id, "picked": picked, "start": time.perf_counter()}
+
+
+def end_profile(handle, endpoint, method, path, status):
+    """
+    Function stops sampling the request and stores the profile when it is kept
+    :param handle: Value returned by begin_profile
+    :return: Id of the stored profile or None if it was dropped
+    """
+    stacks = sampler.stop(handle["thread_id"])
+    duration_ms = (time.perf_counter() - handle["start"]) * 1000
+    slow = duration_ms >= PROFILE_SLOW_MS
+    if not (slow or handle["picked"]) or not stacks:
+        return None
+
+    profile = {
+        "endpoint": endpoint,
+        "method": method,
+        "path": path,
+        "status": status,
+        "duration_ms": round(duration_ms, 2),
+        "reason": "slow" if slow else "sampled",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "interval_ms": PROFILE_INTERVAL_MS,
+        "samples": sum(stacks.values()),
+        "stacks": stacks,
+    }
+    try:
+        return profile_store.save(profile)
+    except OSError as e:
+        print("Error saving profile:", e)
+        return None
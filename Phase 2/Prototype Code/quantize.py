@@ -0,0 +1,295 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+from model_registry import build_session_options, model_input_size, variant_path, MODEL_PATH
+from postprocess import decode_output, batched_nms, scale_boxes, box_iou
+from preprocess import prepare_image
+
+
+"""
+
+#######################################################################################################################################################################333
+QUANTIZED MODEL VARIANTS
+
+Builds INT8 and FP16 versions of the detector next to the FP32 model and
+benchmarks them against it. A variant written here is served by setting
+REVA_MODEL_VARIANT to its name, e.g. REVA_MODEL_VARIANT=int8-dynamic.
+
+    python quantize.py dynamic
+    python quantize.py static --calibration-dir calibration/
+    python quantize.py fp16
+    python quantize.py benchmark --images samples/ --variants int8-dynamic int8-static fp16
+
+Quantization needs the "onnx" package, FP16 conversion also needs "onnxconverter-common".
+"""
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.JPG", "*.JPEG", "*.PNG")
+
+
+def list_images(folder, limit=None):
+    """
+    Function lists the images of a folder in a stable order
+    :param folder: Folder holding the images
+    :param limit: Maximum number of images, None for all of them
+    :return: List of image paths
+    """
+    paths = sorted({path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(folder, pattern))})
+    return paths[:limit] if limit else paths
+
+
+def quantize_dynamic_variant(model_path=MODEL_PATH, output_path=None):
+    """
+    Function writes a dynamically quantized INT8 variant, weights are quantized
+    ahead of time and activations at run time, no calibration data needed
+    :param model_path: Path of the FP32 ONNX model
+    :param output_path: Where to write the variant, defaults to "<model>.int8-dynamic.onnx"
+    :return: Path of the written variant
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    output_path = output_path or variant_path(model_path, "int8-dynamic")
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QUInt8)
+    return output_path
+
+
+class ImageCalibrationReader:
+    """
+    Calibration data reader feeding preprocessed images from a folder to the static quantizer
+    """
+
+    def __init__(self, image_paths, input_name, input_size):
+        self.image_paths = list(image_paths)
+        self.input_name = input_name
+        self.input_size = input_size
+        self._index = 0
+
+    def get_next(self):
+        if self._index >= len(self.image_paths):
+            return None
+        path = self.image_paths[self._index]
+        self._index += 1
+        with open(path, "rb") as file:
+            tensor, _, _ = prepare_image(file, self.input_size)
+        # the preprocessing buffer is reused, the quantizer keeps the inputs around
+        return {self.input_name: tensor.copy()}
+
+    def rewind(self):
+        self._index = 0
+
+
+def quantize_static_variant(model_path=MODEL_PATH, calibration_dir="calibration", output_path=None,
+                            max_images=100, per_channel=True, method="minmax"):
+    """
+    Function writes a statically quantized INT8 variant in QDQ format,
+    activation ranges are calibrated on a folder of representative images
+    :param model_path: Path of the FP32 ONNX model
+    :param calibration_dir: Folder of calibration images
+    :param output_path: Where to write the variant, defaults to "<model>.int8-static.onnx"
+    :param max_images: Maximum number of calibration images used
+    :param per_channel: Quantize weights per output channel
+    :param method: Calibration method, one of "minmax", "entropy" or "percentile"
+    :return: Path of the written variant
+    """
+    from onnxruntime.quantization import quantize_static, CalibrationMethod, QuantFormat, QuantType
+
+    methods = {
+        "minmax": CalibrationMethod.MinMax,
+        "entropy": CalibrationMethod.Entropy,
+        "percentile": CalibrationMethod.Percentile,
+    }
+    if method not in methods:
+        raise ValueError(f"Unknown calibration method: {method}")
+
+    image_paths = list_images(calibration_dir, max_images)
+    if not image_paths:
+        raise ValueError(f"No calibration images found in {calibration_dir}")
+
+    session = ort.InferenceSession(model_path)
+    reader = ImageCalibrationReader(image_paths, session.get_inputs()[0].name, model_input_size(session))
+
+    output_path = output_path or variant_path(model_path, "int8-static")
+    quantize_static(model_path, output_path, reader,
+                    quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    per_channel=per_channel,
+                    calibrate_method=methods[method])
+    return output_path
+
+
+def convert_fp16_variant(model_path=MODEL_PATH, output_path=None):
+    """
+    Function writes an FP16 variant, inputs and outputs stay float32 so the
+    preprocessing and postprocessing code does not change
+    :param model_path: Path of the FP32 ONNX model
+    :param output_path: Where to write the variant, defaults to "<model>.fp16.onnx"
+    :return: Path of the written variant
+    """
+    import onnx
+    try:
+        from onnxconverter_common import float16
+    except ImportError:
+        raise ImportError("FP16 conversion needs the onnxconverter-common package")
+
+    output_path = output_path or variant_path(model_path, "fp16")
+    model = float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+    onnx.save(model, output_path)
+    return output_path
+
+
+def detect_arrays(session, tensor, img_width, img_height, input_size, conf_threshold=0.2, iou_threshold=0.3):
+    """
+    Function runs a session on one prepared input and returns the kept boxes as arrays
+    :param session: onnxruntime.InferenceSession
+    :param tensor: Numpy array in a shape (1,3,input_size,input_size)
+    :param img_width: The width of original image
+    :param img_height: The height of original image
+    :param input_size: Side of the square model input
+    :param conf_threshold: Minimum class probability for a candidate to be kept
+    :param iou_threshold: Boxes overlapping a kept box by this much or more are dropped
+    :return: Tuple of boxes (n,4) in image pixels, scores (n,) and class ids (n,)
+    """
+    output = session.run(["output0"], {"images": tensor})[0]
+    boxes, scores, class_ids = decode_output(output, conf_threshold)
+    keep = batched_nms(boxes, scores, class_ids, iou_threshold=iou_threshold, agnostic=True)
+    return scale_boxes(boxes[keep], img_width, img_height, input_size), scores[keep], class_ids[keep]
+
+
+def match_boxes(reference, candidate, iou_threshold=0.5):
+    """
+    Function greedily matches candidate boxes to reference boxes of the same class,
+    highest scoring candidates first, each reference box is matched at most once
+    :param reference: Tuple (boxes, scores, class_ids) treated as ground truth
+    :param candidate: Tuple (boxes, scores, class_ids) to evaluate
+    :param iou_threshold: Minimum IoU for a match
+    :return: Number of matched boxes
+    """
+    ref_boxes, _, ref_classes = reference
+    boxes, scores, classes = candidate
+    if len(ref_boxes) == 0 or len(boxes) == 0:
+        return 0
+
+    used = np.zeros(len(ref_boxes), dtype=bool)
+    matched = 0
+    for index in np.argsort(-scores, kind="stable"):
+        ious = box_iou(boxes[index], ref_boxes)
+        ious[used | (ref_classes != classes[index])] = -1
+        best = int(ious.argmax())
+        if ious[best] >= iou_threshold:
+            used[best] = True
+            matched += 1
+    return matched
+
+
+def benchmark_variants(model_path=MODEL_PATH, variants=("int8-dynamic", "int8-static", "fp16"), image_dir="samples",
+                       max_images=50, warmup=2, iou_threshold=0.5):
+    """
+    Function measures latency, throughput and box level agreement with the FP32 model for each variant
+    :param model_path: Path of the FP32 ONNX model used as reference
+    :param variants: Names of the variants to compare, missing files are skipped
+    :param image_dir: Folder of evaluation images
+    :param max_images: Maximum number of evaluation images
+    :param warmup: Untimed runs before measuring each model
+    :param iou_threshold: Minimum IoU for a box to count as agreeing with FP32
+    :return: Dictionary of results keyed by variant name
+    """
+    image_paths = list_images(image_dir, max_images)
+    if not image_paths:
+        raise ValueError(f"No images found in {image_dir}")
+
+    # prepare every image once, all variants share the input size of the FP32 model
+    reference_session = ort.InferenceSession(model_path, build_session_options())
+    input_size = model_input_size(reference_session)
+    inputs = []
+    for path in image_paths:
+        with open(path, "rb") as file:
+            tensor, img_width, img_height = prepare_image(file, input_size)
+        inputs.append((tensor.copy(), img_width, img_height))
+
+    results = {}
+    reference = None
+    for name in ("fp32",) + tuple(variants):
+        path = variant_path(model_path, name)
+        if not os.path.exists(path):
+            print(f"Skipping {name}, {path} not found")
+            continue
+
+        session = reference_session if name == "fp32" else ort.InferenceSession(path, build_session_options())
+        for tensor, _, _ in inputs[:warmup]:
+            session.run(["output0"], {"images": tensor})
+
+        latencies = []
+        detections = []
+        for tensor, img_width, img_height in inputs:
+            start = time.perf_counter()
+            detections.append(detect_arrays(session, tensor, img_width, img_height, input_size))
+            latencies.append(time.perf_counter() - start)
+
+        if reference is None:
+            reference = detections
+
+        ref_total = sum(len(ref[0]) for ref in reference)
+        total = sum(len(det[0]) for det in detections)
+        matched = sum(match_boxes(ref, det, iou_threshold) for ref, det in zip(reference, detections))
+
+        latencies_ms = np.array(latencies) * 1000
+        results[name] = {
+            "path": path,
+            "size_mb": round(os.path.getsize(path) / 1e6, 2),
+            "latency_ms_mean": round(float(latencies_ms.mean()), 2),
+            "latency_ms_p50": round(float(np.percentile(latencies_ms, 50)), 2),
+            "latency_ms_p95": round(float(np.percentile(latencies_ms, 95)), 2),
+            "throughput_ips": round(len(latencies) / float(np.sum(latencies)), 2),
+            "detections": total,
+            "precision_vs_fp32": round(matched / total, 4) if total else 1.0,
+            "recall_vs_fp32": round(matched / ref_total, 4) if ref_total else 1.0,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and benchmark quantized variants of the detector")
+    parser.add_argument("--model", default=MODEL_PATH, help="FP32 ONNX model")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    dynamic = commands.add_parser("dynamic", help="INT8 dynamic quantization")
+    dynamic.add_argument("--output")
+
+    static = commands.add_parser("static", help="INT8 static quantization calibrated on images")
+    static.add_argument("--calibration-dir", default="calibration")
+    static.add_argument("--max-images", type=int, default=100)
+    static.add_argument("--method", default="minmax", choices=["minmax", "entropy", "percentile"])
+    static.add_argument("--per-tensor", action="store_true", help="quantize weights per tensor instead of per channel")
+    static.add_argument("--output")
+
+    fp16 = commands.add_parser("fp16", help="FP16 conversion")
+    fp16.add_argument("--output")
+
+    benchmark = commands.add_parser("benchmark", help="compare variants against the FP32 model")
+    benchmark.add_argument("--images", default="samples")
+    benchmark.add_argument("--variants", nargs="+", default=["int8-dynamic", "int8-static", "fp16"])
+    benchmark.add_argument("--max-images", type=int, default=50)
+    benchmark.add_argument("--iou", type=float, default=0.5)
+
+    args = parser.parse_args()
+    if args.command == "dynamic":
+        print("Wrote", quantize_dynamic_variant(args.model, args.output))
+    elif args.command == "static":
+        print("Wrote", quantize_static_variant(args.model, args.calibration_dir, args.output,
+                                               args.max_images, not args.per_tensor, args.method))
+    elif args.command == "fp16":
+        print("Wrote", convert_fp16_variant(args.model, args.output))
+    else:
+        results = benchmark_variants(args.model, args.variants, args.images, args.max_images,
+                                     iou_threshold=args.iou)
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import time
+
+from db import get_connection
+from metrics import stage
+
+
+"""
+
+#######################################################################################################################################################################333
+DETECTION REPOSITORY
+
+All reads and writes of detections go through here. An uploaded image is stored
+once as a row of the image table (user, filename, location) and its boxes point
+to it, so saving an image is one transaction with a single executemany instead
+of one connection and one commit per box. The image row also keeps its number of
+boxes, and the per user, per location and per day totals are updated in the same
+transaction, so the dashboard reads never count boxes again. Images carrying a
+content hash are stored once per user: uploading the same file again adds no
+image, and when it was run with other settings its boxes and counts are replaced
+by the new ones.
+"""
+
+
+def _update_summaries(cursor, user_id, latitude, longitude, day, detection_count, image_count=1):
+    # add to the running totals, same keys and rules as the backfill in migrations.py.
+    # image_count=0 with a detection_count difference corrects an image stored before
+    if user_id is None:
+        return
+    cursor.execute("""
+        INSERT INTO user_summary (user_id, image_count, detection_count) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET image_count = image_count + excluded.image_count,
+                                            detection_count = detection_count + excluded.detection_count
+    """, (user_id, image_count, detection_count))
+    if latitude is not None and longitude is not None:
+        cursor.execute("""
+            INSERT INTO location_summary (user_id, latitude, longitude, image_count, detection_count) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, latitude, longitude) DO UPDATE SET image_count = image_count + excluded.image_count,
+                                                                     detection_count = detection_count + excluded.detection_count
+        """, (user_id, latitude, longitude, image_count, detection_count))
+    cursor.execute("""
+        INSERT INTO daily_summary (user_id, day, image_count, detection_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET image_count = image_count + excluded.image_count,
+                                                 detection_count = detection_count + excluded.detection_count
+    """, (user_id, day, image_count, detection_count))
+
+
+def _image_day(captured_at, created_at):
+    # UTC day the image was taken, or stored when the capture time is unknown
+    return time.strftime("%Y-%m-%d", time.gmtime(captured_at if captured_at is not None else created_at))
+
+
+def _insert_boxes(cursor, image_id, boxes):
+    cursor.executemany(
+        "INSERT INTO object_detection_data (image_id, x1, y1, x2, y2, object_type, probability) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(image_id, x1, y1, x2, y2, object_type, probability) for x1, y1, x2, y2, object_type, probability in boxes]
+    )
+
+
+def _replace_boxes(cursor, user_id, image, boxes):
+    # same file run again, with other settings or another model its boxes differ from the stored ones
+    image_id, latitude, longitude, captured_at, created_at, detection_count = image
+    stored = cursor.execute(
+        "SELECT x1, y1, x2, y2, object_type, probability FROM object_detection_data WHERE image_id = ? ORDER BY id",
+        (image_id,)
+    ).fetchall()
+    if stored == [tuple(box) for box in boxes]:
+        return
+    cursor.execute("DELETE FROM object_detection_data WHERE image_id = ?", (image_id,))
+    _insert_boxes(cursor, image_id, boxes)
+    cursor.execute("UPDATE image SET detection_count = ? WHERE id = ?", (len(boxes), image_id))
+    _update_summaries(cursor, user_id, latitude, longitude, _image_day(captured_at, created_at),
+                      len(boxes) - (detection_count or 0), image_count=0)
+
+
+def _insert_image(cursor, user_id, filename, boxes, latitude, longitude, captured_at=None, content_hash=None):
+    if content_hash is not None:
+        # same file uploaded again by the same user, keep the first row and the latest boxes
+        row = cursor.execute(
+            "SELECT id, latitude, longitude, captured_at, created_at, detection_count FROM image WHERE user_id IS ? AND content_hash = ? LIMIT 1",
+            (user_id, content_hash)
+        ).fetchone()
+        if row:
+            _replace_boxes(cursor, user_id, row, boxes)
+            return row[0]
+
+    created_at = time.time()
+    cursor.execute(
+        "INSERT INTO image (user_id, filename, latitude, longitude, captured_at, detection_count, created_at, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, filename, latitude, longitude, captured_at, len(boxes), created_at, content_hash)
+    )
+    # read before the summary upserts, they change lastrowid to the summary row's key
+    image_id = cursor.lastrowid
+    _update_summaries(cursor, user_id, latitude, longitude, _image_day(captured_at, created_at), len(boxes))
+    _insert_boxes(cursor, image_id, boxes)
+    return image_id
+
+
+def save_images(db_path, images):
+    """
+    Function stores several images and all their boxes in a single transaction
+    :param db_path: Path of the SQLite database
+    :param images: List of tuples (user_id, filename, boxes, latitude, longitude[, captured_at[, content_hash]])
+                   where boxes are in format [[x1,y1,x2,y2,object_type,probability],..]
+    :return: List of the image ids, the existing id for an image the user already stored
+    """
+    connection = get_connection(db_path)
+    # the connection context manager commits once at the end or rolls everything back
+    with stage("db_write"), connection:
+        cursor = connection.cursor()
+        return [_insert_image(cursor, *image) for image in images]
+
+
+def save_image(db_path, user_id, filename, boxes, latitude, longitude, captured_at=None, content_hash=None):
+    """
+    Function stores one image and all its boxes in a single transaction
+    :param db_path: Path of the SQLite database
+    :param user_id: Owner of the image
+    :param filename: Name of the uploaded file
+    :param boxes: Array of detected objects in a format [[x1,y1,x2,y2,object_type,probability],..]
+    :param latitude: Latitude of the image
+    :param longitude: Longitude of the image
+    :param captured_at: Unix time the image was taken, None when unknown
+    :param content_hash: SHA-256 of the uploaded file, None to always store the image
+    :return: Id of the new image, or of the same file stored before
+    """
+    return save_images(db_path, [(user_id, filename, boxes, latitude, longitude, captured_at, content_hash)])[0]
+
+
+def _fetch(db_path, query, params, one=False):
+    cursor = get_connection(db_path).execute(query, params)
+    return cursor.fetchone() if one else cursor.fetchall()
+
+
+def fetch_image_location(db_path, user_id, filename):
+    """
+    Function returns the location of one of the user's images
+    :return: Tuple (latitude, longitude) or None
+    """
+    return _fetch(db_path, """
+        SELECT latitude, longitude FROM image
+        WHERE user_id = ? AND filename = ? AND detection_count > 0 LIMIT 1
+    """, (user_id, filename), one=True)
+
+
+def fetch_filename_counts(db_path, user_id):
+    """
+    Function returns the number of detections per filename of a user
+    :return: List of tuples (filename, count)
+    """
+    return _fetch(db_path, """
+        SELECT filename, SUM(detection_count) FROM image
+        WHERE user_id = ? AND detection_count > 0 GROUP BY filename
+    """, (user_id,))
+
+
+def fetch_locations(db_path, user_id):
+    """
+    Function returns the distinct locations where a user has detections
+    :return: List of tuples (latitude, longitude)
+    """
+    return _fetch(db_path, """
+        SELECT latitude, longitude FROM location_summary
+        WHERE user_id = ? AND detection_count > 0 ORDER BY latitude, longitude
+    """, (user_id,))
+
+
+def fetch_user_totals(db_path, user_id):
+    """
+    Function returns the running totals of a user
+    :return: Tuple (image_count, detection_count), zeros for a user without images
+    """
+    row = _fetch(db_path, "SELECT image_count, detection_count FROM user_summary WHERE user_id = ?",
+                 (user_id,), one=True)
+    return row if row else (0, 0)
+
+
+def fetch_daily_counts(db_path, user_id):
+    """
+    Function returns the number of images and detections per day of a user, oldest first
+    :return: List of tuples (day "YYYY-MM-DD", image_count, detection_count)
+    """
+    return _fetch(db_path, """
+        SELECT day, image_count, detection_count FROM daily_summary
+        WHERE user_id = ? ORDER BY day
+    """, (user_id,))
+
+
+def fetch_image_summary(db_path, user_id):
+    """
+    Function returns the number of detections per filename and location of a user
+    :return: List of tuples (filename, count, latitude, longitude)
+    """
+    return _fetch(db_path, """
+        SELECT filename, SUM(detection_count), latitude, longitude FROM image
+        WHERE user_id = ? AND detection_count > 0 GROUP BY filename, latitude, longitude
+    """, (user_id,))
+
+
+def count_filename_detections(db_path, user_id, filename):
+    """
+    Function returns the number of detections stored for a filename of a user
+    :return: Number of detections
+    """
+    return _fetch(db_path, """
+        SELECT COALESCE(SUM(detection_count), 0) FROM image
+        WHERE user_id = ? AND filename = ?
+    """, (user_id, filename), one=True)[0]
+
+
+def fetch_user_detections(db_path, user_id):
+    """
+    Function returns every detection of a user in the original object_detection_data column order
+    :return: List of tuples (id, user_id, filename, x1, y1, x2, y2, object_type, probability, latitude, longitude)
+    """
+    return _fetch(db_path, """
+        SELECT object_detection_data.id, image.user_id, image.filename,
+               object_detection_data.x1, object_detection_data.y1, object_detection_data.x2, object_detection_data.y2,
+               object_detection_data.object_type, object_detection_data.probability, image.latitude, image.longitude
+        FROM image
+        JOIN object_detection_data ON object_detection_data.image_id = image.id
+        WHERE image.user_id = ?
+    """, (user_id,))
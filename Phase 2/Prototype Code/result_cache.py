@@ -0,0 +1,176 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_connection
+from metrics import cache_lookup
+
+
+"""
+
+#######################################################################################################################################################################333
+DETECTION RESULT CACHE
+
+Detections are cached by the content of the image, the model that produced them
+and the settings used (thresholds, tiling and JPEG draft decoding), so an image uploaded again is answered without running
+the model. Recent results are kept in memory, all results in a SQLite file that
+is trimmed to RESULT_CACHE_MAX_MB by dropping the least recently used entries.
+"""
+
+RESULT_CACHE_ENABLED = os.environ.get("REVA_RESULT_CACHE", "1") == "1"
+
+# SQLite file of the persistent tier and its size budget
+RESULT_CACHE_PATH = os.environ.get("REVA_RESULT_CACHE_PATH", "result_cache.db")
+RESULT_CACHE_MAX_MB = float(os.environ.get("REVA_RESULT_CACHE_MAX_MB", "256"))
+
+# Results kept in memory by each process
+RESULT_CACHE_ENTRIES = int(os.environ.get("REVA_RESULT_CACHE_ENTRIES", "1024"))
+
+
+def content_hash(data):
+    """
+    Function returns the SHA-256 of an image
+    :param data: bytes, memoryview or mmap holding the whole file
+    :return: Hex digest
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def model_version(model_path):
+    """
+    Function identifies the model file at a path, replacing the file gives a new version
+    :param model_path: Path of the ONNX model
+    :return: String made of the file name, size and modification time
+    """
+    stat = os.stat(model_path)
+    return f"{os.path.basename(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def result_key(image_hash, model_path, **settings):
+    """
+    Function builds the cache key of a detection
+    :param image_hash: content_hash of the image
+    :param model_path: Path of the ONNX model used
+    :param settings: Everything else changing the result, e.g. tiled, thresholds
+    :return: Hex digest
+    """
+    parts = [image_hash, model_version(model_path), sorted(settings.items())]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Two tier cache of detection results, an in-memory LRU in front of a size bounded SQLite table
+    """
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_entries=RESULT_CACHE_ENTRIES, max_mb=RESULT_CACHE_MAX_MB):
+        """
+        :param path: SQLite file of the persistent tier, None for memory only
+        :param max_entries: Results kept in memory
+        :param max_mb: Size budget of the persistent tier in megabytes
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connection(self):
+        connection = get_connection(self.path)
+        if not self._ready:
+            with connection:
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS result_cache (
+                        key TEXT PRIMARY KEY,
+                        boxes TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        last_used REAL NOT NULL
+                    )
+                """)
+                connection.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_last_used ON result_cache (last_used)")
+                # running total of the sizes, kept in the same transactions as the entries
+                connection.execute("CREATE TABLE IF NOT EXISTS result_cache_size (id INTEGER PRIMARY KEY CHECK (id = 1), total INTEGER NOT NULL)")
+                connection.execute("INSERT OR IGNORE INTO result_cache_size (id, total) SELECT 1, total(size) FROM result_cache")
+            self._ready = True
+        return connection
+
+    def _remember(self, key, boxes):
+        with self._lock:
+            self._memory[key] = boxes
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Function returns the cached boxes of a key
+        :param key: result_key of the detection
+        :return: Array of boxes in format [[x1,y1,x2,y2,object_type,probability],..], None on a miss
+        """
+        with self._lock:
+            boxes = self._memory.get(key)
+            if boxes is not None:
+                self._memory.move_to_end(key)
+        if boxes is None and self.path:
+            connection = self._connection()
+            row = connection.execute("SELECT boxes FROM result_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                boxes = json.loads(row[0])
+                with connection:
+                    connection.execute("UPDATE result_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._remember(key, boxes)
+        cache_lookup("result", boxes is not None)
+        # callers get their own lists, the cached ones stay untouched
+        return [list(box) for box in boxes] if boxes is not None else None
+
+    def put(self, key, boxes):
+        """
+        Function stores the boxes of a key in both tiers
+        :param key: result_key of the detection
+        :param boxes: Array of boxes in format [[x1,y1,x2,y2,object_type,probability],..]
+        """
+        boxes = [list(box) for box in boxes]
+        self._remember(key, boxes)
+        if not self.path:
+            return
+
+        payload = json.dumps(boxes)
+        connection = self._connection()
+        with connection:
+            old = connection.execute("SELECT size FROM result_cache WHERE key = ?", (key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO result_cache (key, boxes, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, payload, len(payload), time.time())
+            )
+            connection.execute("UPDATE result_cache_size SET total = total + ? WHERE id = 1",
+                               (len(payload) - (old[0] if old else 0),))
+            total = connection.execute("SELECT total FROM result_cache_size WHERE id = 1").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(connection, total)
+
+    def _evict(self, connection, total):
+        # drop least recently used entries down to 90% of the budget so eviction does not run on every insert
+        target = self.max_bytes * 0.9
+        freed = 0
+        keys = []
+        for key, size in connection.execute("SELECT key, size FROM result_cache ORDER BY last_used"):
+            if total - freed <= target:
+                break
+            keys.append((key,))
+            freed += size
+        connection.executemany("DELETE FROM result_cache WHERE key = ?", keys)
+        connection.execute("UPDATE result_cache_size SET total = total - ? WHERE id = 1", (freed,))
+
+        with self._lock:
+            for (key,) in keys:
+                self._memory.pop(key, None)
+
+
+# Shared cache for the whole process
+result_cache = ResultCache()
@@ -0,0 +1,95 @@
+import io
+import struct
+
+import pytest
+from PIL import Image
+
+from exif_metadata import GPS_POINTER, read_image_metadata
+
+# 2024-05-06 07:08:09 UTC
+CAPTURED_AT = 1714979289.0
+
+
+def _exif(gps=True):
+    exif = Image.Exif()
+    exif[0x0132] = "2024:05:06 07:08:09"
+    if gps:
+        ifd = exif.get_ifd(GPS_POINTER)
+        ifd[1] = "S"
+        ifd[2] = (10.0, 30.0, 36.0)
+        ifd[3] = "W"
+        ifd[4] = (106.0, 15.0, 0.0)
+        ifd[5] = b"\x00"
+        ifd[6] = 12.5
+    return exif
+
+
+def _image(fmt, gps=True):
+    exif = _exif(gps)
+    if fmt == "TIFF":
+        # Pillow drops the GPS IFD when saving a TIFF, the EXIF block itself is a complete TIFF structure
+        return exif.tobytes()[6:]
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), "red").save(buffer, fmt, exif=exif)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "TIFF", "PNG", "WEBP"])
+def test_gps_position_is_read(fmt):
+    metadata = read_image_metadata(_image(fmt))
+
+    assert metadata["latitude"] == pytest.approx(-10.51)
+    assert metadata["longitude"] == pytest.approx(-106.25)
+    assert metadata["altitude"] == pytest.approx(12.5)
+    assert metadata["captured_at"] == CAPTURED_AT
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "TIFF", "PNG", "WEBP"])
+def test_missing_gps_leaves_the_position_empty(fmt):
+    metadata = read_image_metadata(_image(fmt, gps=False))
+
+    assert metadata == {"latitude": None, "longitude": None, "altitude": None, "captured_at": CAPTURED_AT}
+
+
+def test_file_object_is_read_from_its_start():
+    file = io.BytesIO(_image("JPEG"))
+    file.seek(100)
+
+    assert read_image_metadata(file)["latitude"] == pytest.approx(-10.51)
+    assert file.tell() == 100
+
+
+def test_image_without_exif():
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16)).save(buffer, "PNG")
+
+    assert read_image_metadata(buffer.getvalue()) == {
+        "latitude": None, "longitude": None, "altitude": None, "captured_at": None}
+
+
+def test_truncated_gps_ifd_is_not_an_error():
+    data = _image("TIFF")
+    endian = "<" if data[:2] == b"II" else ">"
+    # IFD0 sits at the offset in the header, find its GPS pointer entry
+    ifd0 = struct.unpack(endian + "I", data[4:8])[0]
+    count = struct.unpack(endian + "H", data[ifd0:ifd0 + 2])[0]
+    gps_ifd = None
+    for index in range(count):
+        entry = ifd0 + 2 + index * 12
+        tag = struct.unpack(endian + "H", data[entry:entry + 2])[0]
+        if tag == GPS_POINTER:
+            gps_ifd = struct.unpack(endian + "I", data[entry + 8:entry + 12])[0]
+    assert gps_ifd is not None
+
+    # cut in the middle of the second GPS entry
+    metadata = read_image_metadata(data[:gps_ifd + 2 + 12 + 5])
+
+    # the read stops at the broken entry, before the capture time is looked up
+    assert metadata == {"latitude": None, "longitude": None, "altitude": None, "captured_at": None}
+
+
+@pytest.mark.parametrize("size", [2, 8, 30, 60, 120])
+def test_truncated_jpeg_does_not_raise(size):
+    metadata = read_image_metadata(_image("JPEG")[:size])
+
+    assert set(metadata) == {"latitude", "longitude", "altitude", "captured_at"}
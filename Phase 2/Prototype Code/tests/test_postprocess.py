@@ -0,0 +1,82 @@
+import numpy as np
+
+from postprocess import box_iou, nms, batched_nms
+
+
+def _iou(a, b):
+    # plain Python intersection over union of two [x1,y1,x2,y2] boxes
+    width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _naive_nms(boxes, scores, class_ids, iou_threshold, top_k=None, agnostic=False):
+    # greedy reference: take the best box left, drop every box of its class overlapping it
+    order = sorted(range(len(scores)), key=lambda i: -scores[i])
+    keep = []
+    for i in order:
+        if top_k is not None and len(keep) >= top_k:
+            break
+        if all((not agnostic and class_ids[i] != class_ids[k]) or _iou(boxes[i], boxes[k]) < iou_threshold
+               for k in keep):
+            keep.append(i)
+    return keep
+
+
+def _random_boxes(rng, count, classes=3):
+    corners = rng.uniform(0, 200, size=(count, 2))
+    sizes = rng.uniform(5, 60, size=(count, 2))
+    boxes = np.hstack([corners, corners + sizes]).astype(np.float32)
+    # distinct scores so the greedy order is the same for both implementations
+    scores = rng.permutation(count).astype(np.float32) / count + 0.01
+    class_ids = rng.integers(0, classes, size=count)
+    return boxes, scores, class_ids
+
+
+def test_box_iou_matches_the_reference():
+    rng = np.random.default_rng(0)
+    boxes, _, _ = _random_boxes(rng, 50)
+    expected = [_iou(boxes[0].tolist(), box.tolist()) for box in boxes]
+    assert np.allclose(box_iou(boxes[0], boxes), expected, atol=1e-6)
+
+
+def test_batched_nms_matches_the_naive_reference():
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        boxes, scores, class_ids = _random_boxes(rng, int(rng.integers(2, 120)))
+        box_list, score_list, class_list = boxes.tolist(), scores.tolist(), class_ids.tolist()
+        for iou_threshold in (0.3, 0.5, 0.7):
+            for agnostic in (False, True):
+                expected = _naive_nms(box_list, score_list, class_list, iou_threshold, agnostic=agnostic)
+                kept = batched_nms(boxes, scores, class_ids, iou_threshold, agnostic=agnostic)
+                assert kept.tolist() == expected
+
+
+def test_batched_nms_stops_at_top_k():
+    rng = np.random.default_rng(2)
+    boxes, scores, class_ids = _random_boxes(rng, 80)
+    expected = _naive_nms(boxes.tolist(), scores.tolist(), class_ids.tolist(), 0.5, top_k=5)
+    assert batched_nms(boxes, scores, class_ids, 0.5, top_k=5).tolist() == expected
+
+
+def test_empty_input_keeps_nothing():
+    boxes = np.empty((0, 4), dtype=np.float32)
+    scores = np.empty(0, dtype=np.float32)
+    class_ids = np.empty(0, dtype=np.int64)
+
+    for agnostic in (False, True):
+        kept = batched_nms(boxes, scores, class_ids, agnostic=agnostic)
+        assert kept.dtype == np.int64 and kept.size == 0
+    assert nms(boxes, scores).size == 0
+
+
+def test_single_box_is_kept():
+    boxes = np.array([[10, 20, 50, 80]], dtype=np.float32)
+    scores = np.array([0.4], dtype=np.float32)
+    class_ids = np.array([2])
+
+    assert batched_nms(boxes, scores, class_ids).tolist() == [0]
+    assert batched_nms(boxes, scores, class_ids, agnostic=True).tolist() == [0]
+    assert nms(boxes, scores, top_k=1).tolist() == [0]
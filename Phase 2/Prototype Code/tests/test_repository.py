@@ -0,0 +1,64 @@
+from db import get_connection
+from migrations import migrate
+from repository import save_image, save_images, fetch_user_totals, fetch_daily_counts
+
+
+def _boxes(count, object_type="plastic"):
+    return [[i, i, i + 10, i + 10, object_type, 0.9] for i in range(count)]
+
+
+def _stored_boxes(db_path, image_id):
+    return get_connection(db_path).execute(
+        "SELECT COUNT(*) FROM object_detection_data WHERE image_id = ?", (image_id,)).fetchone()[0]
+
+
+def test_first_image_of_each_user_keeps_its_boxes(tmp_path):
+    db_path = str(tmp_path / "REVA.db")
+    migrate(db_path)
+
+    # the first image of a user creates its summary rows, whose keys must not be taken as the image id
+    first = save_image(db_path, 1, "a.jpg", _boxes(3), 10.0, 106.0)
+    again = save_image(db_path, 1, "b.jpg", _boxes(1), 10.0, 106.0)
+    other = save_image(db_path, 2, "c.jpg", _boxes(5), 10.5, 106.5)
+
+    assert len({first, again, other}) == 3
+    assert [_stored_boxes(db_path, image_id) for image_id in (first, again, other)] == [3, 1, 5]
+    owners = dict(get_connection(db_path).execute("SELECT id, user_id FROM image").fetchall())
+    assert owners == {first: 1, again: 1, other: 2}
+
+
+def test_save_images_returns_the_new_ids(tmp_path):
+    db_path = str(tmp_path / "REVA.db")
+    migrate(db_path)
+
+    ids = save_images(db_path, [(7, "c.jpg", _boxes(2), 1.0, 2.0), (8, "d.jpg", _boxes(4), 1.0, 2.0)])
+
+    assert [_stored_boxes(db_path, image_id) for image_id in ids] == [2, 4]
+
+
+def test_same_file_run_again_replaces_its_boxes_and_counts(tmp_path):
+    db_path = str(tmp_path / "REVA.db")
+    migrate(db_path)
+
+    first = save_image(db_path, 1, "a.jpg", _boxes(3), 10.0, 106.0, 1688206272.0, "hash-a")
+    # same file with other settings, e.g. a lower confidence threshold
+    again = save_image(db_path, 1, "a.jpg", _boxes(7), 10.0, 106.0, 1688206272.0, "hash-a")
+
+    assert again == first
+    assert _stored_boxes(db_path, first) == 7
+    assert get_connection(db_path).execute("SELECT detection_count FROM image WHERE id = ?", (first,)).fetchone()[0] == 7
+    assert fetch_user_totals(db_path, 1) == (1, 7)
+    assert [counts for _, *counts in fetch_daily_counts(db_path, 1)] == [[1, 7]]
+
+
+def test_same_file_with_the_same_boxes_changes_nothing(tmp_path):
+    db_path = str(tmp_path / "REVA.db")
+    migrate(db_path)
+
+    first = save_image(db_path, 1, "a.jpg", _boxes(3), 10.0, 106.0, None, "hash-a")
+    box_ids = get_connection(db_path).execute("SELECT id FROM object_detection_data ORDER BY id").fetchall()
+    again = save_image(db_path, 1, "a.jpg", _boxes(3), 10.0, 106.0, None, "hash-a")
+
+    assert again == first
+    assert get_connection(db_path).execute("SELECT id FROM object_detection_data ORDER BY id").fetchall() == box_ids
+    assert fetch_user_totals(db_path, 1) == (1, 3)
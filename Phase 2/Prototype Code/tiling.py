@@ -0,0 +1,165 @@
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from batching import static_batch_size
+from model_registry import registry, MODEL_PATH
+from postprocess import decode_output, batched_nms, scale_boxes
+from preprocess import get_input_buffer, write_letterboxed, INPUT_SIZE
+
+
+"""
+
+#######################################################################################################################################################################333
+SLICED INFERENCE
+
+Large drone captures are cut into overlapping tiles at model resolution instead
+of being squeezed into a single input, so small items keep their pixels. Boxes
+from every tile are moved back to image coordinates and merged with one NMS pass
+so objects lying on a seam are only reported once.
+"""
+
+TILED_INFERENCE = os.environ.get("REVA_TILED", "0") == "1"
+
+# Side of a tile in original image pixels, 0 uses the input size of the model
+TILE_SIZE = int(os.environ.get("REVA_TILE_SIZE", "0"))
+
+
+def check_overlap(overlap):
+    """
+    Function validates the fraction of a tile shared with its neighbour
+    :param overlap: Number or text
+    :return: overlap as a float
+    :raises ValueError: When it is not a number in [0, 1), 1 or more needs a tile per pixel and below 0 leaves gaps
+    """
+    overlap = float(overlap)
+    if not 0 <= overlap < 1:
+        raise ValueError(f"overlap must be at least 0 and below 1, got {overlap}")
+    return overlap
+
+
+# Fraction of a tile shared with its neighbour
+TILE_OVERLAP = check_overlap(os.environ.get("REVA_TILE_OVERLAP", "0.2"))
+
+# Tiles stacked into one model run, and model runs in flight at once.
+# Peak memory grows with TILE_BATCH_SIZE * TILE_WORKERS input tensors.
+TILE_BATCH_SIZE = int(os.environ.get("REVA_TILE_BATCH_SIZE", "2"))
+TILE_WORKERS = int(os.environ.get("REVA_TILE_WORKERS", "1"))
+
+
+def tile_origins(length, tile_size, overlap):
+    """
+    Function calculates where tiles start along one side of the image so
+    that they cover it completely with at least the requested overlap
+    :param length: Width or height of the image
+    :param tile_size: Side of a tile
+    :param overlap: Fraction of a tile shared with its neighbour, in [0, 1)
+    :return: List of tile start offsets
+    """
+    overlap = check_overlap(overlap)
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    count = math.ceil((length - tile_size) / stride) + 1
+    # spread the tiles evenly so the last one ends exactly on the image edge
+    step = (length - tile_size) / (count - 1)
+    return [round(i * step) for i in range(count)]
+
+
+def make_tiles(img_width, img_height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Function lists the tiles covering an image
+    :param img_width: The width of original image
+    :param img_height: The height of original image
+    :param tile_size: Side of a tile
+    :param overlap: Fraction of a tile shared with its neighbour
+    :return: List of tiles in format [(x1,y1,x2,y2),..]
+    """
+    tiles = []
+    for y in tile_origins(img_height, tile_size, overlap):
+        for x in tile_origins(img_width, tile_size, overlap):
+            tiles.append((x, y, min(x + tile_size, img_width), min(y + tile_size, img_height)))
+    return tiles
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    # long lived pool so its threads keep their preallocated input buffers between requests
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tile-worker")
+        return _executor
+
+
+def _detect_tile_batch(img, tiles, model_path, input_size, batch_size, conf_threshold, max_candidates):
+    session = registry.get(model_path)
+    # the last chunk may be short, it uses the front of the same buffer
+    tensor = get_input_buffer(input_size, batch_size)[:len(tiles)]
+    for index, tile in enumerate(tiles):
+        write_letterboxed(img.crop(tile), tensor[index], input_size)
+    output = session.run(["output0"], {"images": tensor})[0]
+
+    boxes, scores, class_ids = [], [], []
+    for index, (x1, y1, x2, y2) in enumerate(tiles):
+        tile_boxes, tile_scores, tile_class_ids = decode_output(output[index:index + 1], conf_threshold, max_candidates)
+        tile_boxes = scale_boxes(tile_boxes, x2 - x1, y2 - y1, input_size)
+        tile_boxes += np.array([x1, y1, x1, y1], dtype=np.float32)
+        boxes.append(tile_boxes)
+        scores.append(tile_scores)
+        class_ids.append(tile_class_ids)
+    return boxes, scores, class_ids
+
+
+def detect_tiled(img, model_path=MODEL_PATH, input_size=INPUT_SIZE, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                 batch_size=TILE_BATCH_SIZE, workers=TILE_WORKERS, conf_threshold=0.2, iou_threshold=0.3,
+                 max_detections=None, max_candidates=None):
+    """
+    Function runs the detector over overlapping tiles of an image and merges the results
+    :param img: PIL image in RGB mode
+    :param model_path: Path of the ONNX model
+    :param input_size: Side of the square model input
+    :param tile_size: Side of a tile in original image pixels, 0 for the model input size
+    :param overlap: Fraction of a tile shared with its neighbour
+    :param batch_size: Number of tiles stacked into one model run
+    :param workers: Number of model runs in flight at once
+    :param conf_threshold: Minimum class probability for a candidate to be kept
+    :param iou_threshold: Boxes overlapping a kept box by this much or more are dropped
+    :param max_detections: Maximum number of boxes returned, None for no limit
+    :param max_candidates: Best candidates of each tile and of the whole image handed to NMS, None for no limit
+    :return: Tuple of boxes (n,4) in image pixels, scores (n,) and class ids (n,) after NMS
+    """
+    if static_batch_size(registry.get(model_path)) is not None:
+        batch_size = 1
+    batch_size = max(1, batch_size)
+    tile_size = tile_size or input_size
+
+    tiles = make_tiles(img.width, img.height, tile_size, overlap)
+    chunks = [tiles[i:i + batch_size] for i in range(0, len(tiles), batch_size)]
+
+    if workers > 1 and len(chunks) > 1:
+        # every pool thread fills its own preallocated buffer, PIL crops are read only
+        results = list(_get_executor(workers).map(
+            lambda chunk: _detect_tile_batch(img, chunk, model_path, input_size, batch_size, conf_threshold,
+                                             max_candidates), chunks))
+    else:
+        results = [_detect_tile_batch(img, chunk, model_path, input_size, batch_size, conf_threshold, max_candidates)
+                   for chunk in chunks]
+
+    boxes = np.concatenate([b for result in results for b in result[0]])
+    scores = np.concatenate([s for result in results for s in result[1]])
+    class_ids = np.concatenate([c for result in results for c in result[2]])
+
+    if max_candidates is not None and scores.shape[0] > max_candidates:
+        best = np.argpartition(-scores, max_candidates - 1)[:max_candidates]
+        boxes, scores, class_ids = boxes[best], scores[best], class_ids[best]
+
+    # objects on a seam are found by both tiles, keep the best one
+    keep = batched_nms(boxes, scores, class_ids, iou_threshold=iou_threshold, top_k=max_detections, agnostic=True)
+    return boxes[keep], scores[keep], class_ids[keep]